@@ -0,0 +1,212 @@
+!
+!  efpp_clock.f90:
+!    Timer for the calls generated by efpp's clock markers.
+!
+!        !{  main}{{STT}}   =>   call Clock%start('  main')
+!        !{  main}{flu cr}  =>   call Clock%lap  ('  main','flu cr')
+!        !{{count}}         =>   call Clock%count
+!        !{  main}{{END}}   =>   call Clock%stop ('  main')
+!        !{{print}}         =>   call Clock%print
+!
+!    Add "use efpp_clock_m" to the program unit that has the markers.
+!
+!    The time is measured by system_clock with int64 counts.
+!    The tables are preallocated, so nothing is allocated in
+!    start, lap, count, and stop. A lap is the time since the
+!    previous lap (or start) of the same region.
+!
+!    The report lines start with "efpp_clock:", so that they can
+!    be picked up from the output of many runs or MPI ranks by
+!    efpp_clock_report.py.
+!
+!  Home page:
+!     https://github.com/akageyama/efpp
+!
+module efpp_clock_m
+  use iso_fortran_env, only : int64, real64, output_unit
+  implicit none
+  private
+  public :: Clock
+
+  integer, parameter :: NREGIONS_MAX = 16
+  integer, parameter :: NLAPS_MAX = 256
+
+  type clock__t
+    integer(int64) :: rate = 0
+    integer(int64) :: counter = 0
+    logical :: overflowed = .false.
+    integer :: nregions = 0
+    integer :: region_now = 0
+    character(len=6), dimension(NREGIONS_MAX) :: region_tag = ''
+    integer(int64), dimension(NREGIONS_MAX) :: region_stt = 0
+    integer(int64), dimension(NREGIONS_MAX) :: region_last = 0
+    integer(int64), dimension(NREGIONS_MAX) :: region_total = 0
+    integer, dimension(NREGIONS_MAX) :: region_calls = 0
+    integer :: nlaps = 0
+    integer :: lap_now = 0
+    integer, dimension(NLAPS_MAX) :: lap_region = 0
+    character(len=6), dimension(NLAPS_MAX) :: lap_tag = ''
+    integer(int64), dimension(NLAPS_MAX) :: lap_ticks = 0
+    integer(int64), dimension(NLAPS_MAX) :: lap_calls = 0
+  contains
+    procedure :: start => clock__start
+    procedure :: lap => clock__lap
+    procedure :: count => clock__count
+    procedure :: stop => clock__stop
+    procedure :: print => clock__print
+  end type clock__t
+
+  type(clock__t), save :: Clock
+
+contains
+
+  function region_index(self, tag) result(ans)
+    class(clock__t), intent(inout) :: self
+    character(len=*), intent(in) :: tag
+    integer :: ans
+
+    ! Most calls are for the same region as the previous one.
+    if ( self%region_now > 0 ) then
+      if ( self%region_tag(self%region_now) == tag ) then
+        ans = self%region_now
+        return
+      end if
+    end if
+
+    do ans = 1 , self%nregions
+      if ( self%region_tag(ans) == tag ) then
+        self%region_now = ans
+        return
+      end if
+    end do
+
+    if ( self%nregions == NREGIONS_MAX ) then
+      self%overflowed = .true.
+      ans = 0
+      return
+    end if
+    self%nregions = self%nregions + 1
+    ans = self%nregions
+    self%region_tag(ans) = tag
+    self%region_now = ans
+  end function region_index
+
+
+  function lap_index(self, ir, tag) result(ans)
+    class(clock__t), intent(inout) :: self
+    integer, intent(in) :: ir
+    character(len=*), intent(in) :: tag
+    integer :: ans, i
+
+    ! Laps are usually called in the same order in every loop,
+    ! so try the entry next to the previous one first.
+    do i = self%lap_now + 1 , self%lap_now + self%nlaps
+      ans = mod(i-1, self%nlaps) + 1
+      if ( self%lap_region(ans) == ir .and. self%lap_tag(ans) == tag ) then
+        self%lap_now = ans
+        return
+      end if
+    end do
+
+    if ( self%nlaps == NLAPS_MAX ) then
+      self%overflowed = .true.
+      ans = 0
+      return
+    end if
+    self%nlaps = self%nlaps + 1
+    ans = self%nlaps
+    self%lap_region(ans) = ir
+    self%lap_tag(ans) = tag
+    self%lap_now = ans
+  end function lap_index
+
+
+  subroutine clock__start(self, tag)
+    class(clock__t), intent(inout) :: self
+    character(len=*), intent(in) :: tag
+    integer(int64) :: now
+    integer :: ir
+
+    call system_clock(now, self%rate)
+    ir = region_index(self, tag)
+    if ( ir == 0 ) return
+    self%region_stt(ir) = now
+    self%region_last(ir) = now
+  end subroutine clock__start
+
+
+  subroutine clock__lap(self, tag, lap)
+    class(clock__t), intent(inout) :: self
+    character(len=*), intent(in) :: tag, lap
+    integer(int64) :: now
+    integer :: ir, il
+
+    call system_clock(now)
+    ir = region_index(self, tag)
+    if ( ir == 0 ) return
+    il = lap_index(self, ir, lap)
+    if ( il == 0 ) return
+    self%lap_ticks(il) = self%lap_ticks(il) + (now - self%region_last(ir))
+    self%lap_calls(il) = self%lap_calls(il) + 1
+    self%region_last(ir) = now
+  end subroutine clock__lap
+
+
+  subroutine clock__count(self)
+    class(clock__t), intent(inout) :: self
+
+    self%counter = self%counter + 1
+  end subroutine clock__count
+
+
+  subroutine clock__stop(self, tag)
+    class(clock__t), intent(inout) :: self
+    character(len=*), intent(in) :: tag
+    integer(int64) :: now
+    integer :: ir
+
+    call system_clock(now)
+    ir = region_index(self, tag)
+    if ( ir == 0 ) return
+    self%region_total(ir) = self%region_total(ir) + (now - self%region_stt(ir))
+    self%region_calls(ir) = self%region_calls(ir) + 1
+  end subroutine clock__stop
+
+
+  subroutine clock__print(self)
+    class(clock__t), intent(in) :: self
+    !
+    ! efpp_clock: begin count=         100
+    ! efpp_clock: |  main|flu cr|           1|  1.234567E-03|  12.35
+    ! efpp_clock: |  main|*total|           1|  9.999999E-03| 100.00
+    ! efpp_clock: end
+    !
+    character(len=*), parameter :: FMT = '(a,a6,a,a6,a,i12,a,es14.6,a,f7.2)'
+    real(real64) :: sec, total
+    integer :: ir, il
+
+    write(output_unit,'(a,i12)') 'efpp_clock: begin count=', self%counter
+    do ir = 1 , self%nregions
+      total = real(self%region_total(ir),real64) / max(self%rate,1_int64)
+      do il = 1 , self%nlaps
+        if ( self%lap_region(il) /= ir ) cycle
+        sec = real(self%lap_ticks(il),real64) / max(self%rate,1_int64)
+        write(output_unit,FMT) 'efpp_clock: |', self%region_tag(ir),  &
+                               '|', self%lap_tag(il),                 &
+                               '|', self%lap_calls(il),               &
+                               '|', sec,                              &
+                               '|', 100*sec/max(total,tiny(total))
+      end do
+      write(output_unit,FMT) 'efpp_clock: |', self%region_tag(ir),    &
+                             '|', '*total',                           &
+                             '|', int(self%region_calls(ir),int64),   &
+                             '|', total,                              &
+                             '|', 100.0_real64
+    end do
+    if ( self%overflowed ) then
+      write(output_unit,'(a)') 'efpp_clock: warning: too many tags, some are not counted.'
+    end if
+    write(output_unit,'(a)') 'efpp_clock: end'
+  end subroutine clock__print
+
+end module efpp_clock_m
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+#
+#  efpp_clock_report.py:
+#    Summarizes the timing reports printed by efpp_clock.f90
+#    (call Clock%print) over many runs or MPI ranks.
+#
+#  Usage:
+#    efpp_clock_report.py run1.log run2.log ...
+#    mpirun --tag-output -np 64 ./a.out | efpp_clock_report.py   (Open MPI)
+#    mpiexec -l -n 64 ./a.out | efpp_clock_report.py             (MPICH)
+#
+#  Each "efpp_clock: begin" ... "efpp_clock: end" block is one
+#  sample. For every (region, lap) tag pair, min/mean/max of the
+#  seconds over the samples are shown.
+#
+#  The lines of the ranks are told apart by the text before
+#  "efpp_clock:", e.g., "[1,3]<stdout>:" put by --tag-output,
+#  so that the reports of the ranks may be interleaved.
+#
+#  Home page:
+#     https://github.com/akageyama/efpp
+#
+import re
+import sys
+
+
+#=============================================
+def read_clock_reports(lines_in):
+#=============================================
+    """
+        input = lines including, for example,
+            efpp_clock: begin count=         100
+            efpp_clock: |  main|flu cr|           1|  1.234567E-03|  12.35
+            efpp_clock: |  main|*total|           1|  9.999999E-03| 100.00
+            efpp_clock: end
+        output = list of samples, e.g.,
+            [ { ('  main','flu cr'): (1, 1.234567e-03),
+                ('  main','*total'): (1, 9.999999e-03) }, ... ]
+
+        The samples are kept apart by the prefix of the lines (the
+        text before "efpp_clock:", e.g., "[1,3]<stdout>:" of a rank),
+        and listed in the order of their "end" lines. Other lines are
+        ignored.
+    """
+    pat_begin = re.compile(r'^(.*?)efpp_clock: begin')
+    pat_lap = re.compile(r'^(.*?)efpp_clock: \|(.{6})\|(.{6})\|\s*(\d+)\|\s*(\S+)\|')
+    pat_end = re.compile(r'^(.*?)efpp_clock: end')
+
+    samples = list()
+    open_samples = dict()   # {prefix: sample}
+    for line in lines_in:
+        match_begin = pat_begin.search(line)
+        match_end = pat_end.search(line)
+        match_lap = pat_lap.search(line)
+        if match_begin:
+            open_samples[match_begin.group(1)] = dict()
+        elif match_end:
+            sample = open_samples.pop(match_end.group(1), None)
+            if sample is not None:
+                samples.append(sample)
+        elif match_lap and match_lap.group(1) in open_samples:
+            m = match_lap
+            open_samples[m.group(1)][(m.group(2), m.group(3))] = (int(m.group(4)), float(m.group(5)))
+
+    return samples
+
+
+#=============================================
+def clock_summary(samples):
+#=============================================
+    """
+      {(region, lap): (nsamples, calls_mean, sec_min, sec_mean, sec_max)}
+    """
+    table = dict()
+    for sample in samples:
+        for key, (calls, sec) in sample.items():
+            table.setdefault(key, list()).append((calls, sec))
+
+    summary = dict()
+    for key, values in table.items():
+        secs = [sec for _, sec in values]
+        calls_mean = sum(calls for calls, _ in values) / len(values)
+        summary[key] = (len(values), calls_mean,
+                        min(secs), sum(secs)/len(secs), max(secs))
+    return summary
+
+
+#=============================================
+def print_clock_summary(summary):
+#=============================================
+    print('region    lap   samples       calls      min(s)     mean(s)      max(s)')
+    for region, lap in sorted(summary, key=lambda k: (k[0], k[1]=='*total', k[1])):
+        n, calls, smin, smean, smax = summary[(region, lap)]
+        print('{:6s}  {:6s}  {:7d}  {:10.1f}  {:10.4e}  {:10.4e}  {:10.4e}'.format(
+              region, lap, n, calls, smin, smean, smax))
+
+
+if __name__ == '__main__':
+
+    samples = list()
+    if len(sys.argv)==1:
+        samples = read_clock_reports(sys.stdin)
+    else:
+        for filename in sys.argv[1:]:
+            with open(filename) as f:
+                samples += read_clock_reports(f)
+    if not samples:
+        sys.stderr.write('No efpp_clock report found.\n')
+        sys.exit(1)
+
+    print_clock_summary(clock_summary(samples))
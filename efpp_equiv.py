@@ -0,0 +1,447 @@
+#!/usr/bin/env python3
+#
+#  efpp_equiv.py:
+#    Differential equivalence check of efpp.py against a frozen
+#    reference, with throughput gates. Run it before committing
+#    a change that should not change the output, e.g., a faster
+#    member accessor or alias decoder.
+#
+#  Usage:
+#    efpp_equiv.py                   # compare with the frozen reference
+#    efpp_equiv.py --reference=REV   # compare with efpp.py of git REV
+#    efpp_equiv.py --reference=FILE  # compare with a copy of efpp.py
+#    efpp_equiv.py --save-baseline   # store the present lines/sec
+#
+#  The reference is frozen: it is efpp_equiv_reference.py, a copy of
+#  efpp.py committed next to this script, not HEAD, so a committed
+#  change is still compared with the engine before it, and no git
+#  history is needed. When a change of the output is intended,
+#  freeze the new engine by
+#    efpp_equiv.py --reference=REV --save-baseline
+#  which copies efpp.py of REV (or FILE) into efpp_equiv_reference.py.
+#
+#  Options:
+#    --seed=N        seed of the generated corpus and the fuzzer (default 2018)
+#    --modules=N     number of the generated modules (default 200)
+#    --fuzz=N        number of the fuzzed lines (default 4000)
+#    --tolerance=X   allowed slowdown from the baseline (default 0.3 = 30%)
+#
+#  Four corpora are converted by both engines:
+#    sample     : sample_code/*.ef
+#    generated  : eFortran modules made from templates of all the
+#                 functions of efpp, including adversarial long lines
+#    specialize : the generated modules, by efpp.py --specialize
+#    fuzz       : random lines made of eFortran tokens
+#  The outputs (and the errors, if any) must be byte-identical, and
+#  lines/sec of each corpus must not drop below the baseline stored
+#  in efpp_equiv_baseline.json. Exit status is 1 otherwise, and 2
+#  if the reference cannot be found.
+#
+#  Home page:
+#     https://github.com/akageyama/efpp
+#
+import contextlib
+import difflib
+import inspect
+import io
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import types
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BASELINE_FILE = os.path.join(HERE, 'efpp_equiv_baseline.json')
+REFERENCE_FILE = os.path.join(HERE, 'efpp_equiv_reference.py')
+
+
+#=============================================
+def engine_source(reference):
+#=============================================
+    """
+      (source, label) of efpp.py of a file, or of a git revision.
+      Raises OSError if it cannot be found.
+    """
+    if os.path.isfile(reference):
+        with open(reference) as f:
+            return f.read(), reference
+    try:
+        revision = subprocess.run(['git', '-C', HERE, 'rev-parse', '--verify', '--quiet',
+                                   reference + '^{commit}'],
+                                  check=True, capture_output=True, text=True).stdout.strip()
+        source = subprocess.run(['git', '-C', HERE, 'show', revision + ':efpp.py'],
+                                check=True, capture_output=True, text=True).stdout
+    except subprocess.CalledProcessError:
+        raise OSError('no file or git revision with efpp.py: ' + reference)
+    return source, revision
+
+
+#=============================================
+def load_engine(source, name):
+#=============================================
+    """
+      Loads the source of efpp.py as a module.
+    """
+    module = types.ModuleType(name)
+    module.__file__ = name + '.py'
+    exec(compile(source, name + '.py', 'exec'), module.__dict__)
+    return module
+
+
+#=============================================
+def clear_caches(engine):
+#=============================================
+    for cache in ('lexical_mask_cache', 'alias_list_cache', 'line_decode_alias_dict',
+                  'const_scopes_cache'):
+        if hasattr(engine, cache):
+            getattr(engine, cache).clear()
+    for decoder in ('line_predecode', 'line_decode'):
+        if hasattr(engine, decoder):
+            getattr(engine, decoder).cache_clear()
+
+
+#=============================================
+def run_engine(engine, filename, alias_list, options):
+#=============================================
+    """
+      Returns (output, status, stderr) of the conversion of a file.
+      options = keyword arguments of efpp_lines, e.g., {'specialize': True}
+    """
+    stdout = io.StringIO()
+    stderr = io.StringIO()
+    status = 'ok'
+    text = ''
+    with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+        try:
+            if hasattr(engine, 'efpp_lines'):
+                text = ''.join(engine.efpp_lines(filename, alias_list, **options))
+            else:
+                engine.efpp(filename, alias_list)
+                text = stdout.getvalue()
+        except SystemExit as e:
+            status = 'exit ' + str(e.code)
+            text = stdout.getvalue()
+        except Exception as e:
+            status = type(e).__name__ + ': ' + str(e)
+    return text, status, stderr.getvalue()
+
+
+#=============================================
+def run_corpus(engine, filenames, alias_list, options, repeat=3):
+#=============================================
+    """
+      Returns ({filename: result}, best seconds of 'repeat' runs).
+    """
+    best = None
+    for _ in range(repeat):
+        clear_caches(engine)
+        results = dict()
+        clock = time.perf_counter()
+        for filename in filenames:
+            results[filename] = run_engine(engine, filename, alias_list, options)
+        sec = time.perf_counter() - clock
+        best = sec if best is None else min(best, sec)
+    return results, best
+
+
+#=============================================
+def first_difference(filename, ref, cur):
+#=============================================
+    lines = ['mismatch in ' + filename]
+    if ref[1:] != cur[1:]:
+        lines.append('  reference: ' + ref[1] + ' ' + ref[2].strip())
+        lines.append('  current  : ' + cur[1] + ' ' + cur[2].strip())
+    diff = difflib.unified_diff(ref[0].splitlines(), cur[0].splitlines(),
+                                'reference', 'current', n=0, lineterm='')
+    lines += ['  ' + l for l in list(diff)[:12]]
+    return '\n'.join(lines)
+
+
+CONSTANTS = '''module constants_m
+  implicit none
+  integer <const> :: SI = selected_int_kind(6)
+  integer <const> :: DR = selected_real_kind(15)
+  integer(SI) <const> :: NX = 16, NY = NX/2 + 1_SI, NZ = max(NX, NY)*2
+end module constants_m
+'''
+
+
+ALIAS_LIST = '''
+  "__EFPPVER__" => "180831"
+  "do i bulk" => "do i = 1 , NX"
+  "do j bulk" => "do j = 1 , NY"
+  "!debugp " => "print *, 'db __MODULE__(__LINE__): ', "
+'''
+
+
+#=============================================
+def generated_module(rng, n):
+#=============================================
+    """
+      One eFortran module using all the functions of efpp.
+    """
+    name = 'gen' + str(n)
+    lines = [ '!!>',
+              '   generated by efpp_equiv.py, ver.__EFPPVER__',
+              '     a.b += 1 ; -call x()  <in>',
+              '!!<',
+              'module ' + name + '_m',
+              '  use constants_m',
+              '  implicit none',
+              '  private',
+              '  public :: ' + name + '__t, ' + name + '__run',
+              '  type ' + name + '__t',
+              '    real(DR), dimension(NX,NY,NZ) :: f, g',
+              '    integer(SI) :: step = 0',
+              '    integer(SI) :: nx = NX',
+              '    character(len=64) :: msg = "a.b += c !x"',
+              '  end type ' + name + '__t',
+              'contains' ]
+
+    def statement(k):
+        choice = rng.randrange(26)
+        if choice == 0:
+            return ['    state.f(:,:,:) += state.g(:,:,:) * 0.5_DR']
+        if choice == 1:
+            return ['    if ( state.step > %d .and. .not. done ) state.step -= 1' % k]
+        if choice == 2:
+            return ['    call state.advance(time.dt, 1.e-%d)  ! note: a.b += c' % k]
+        if choice == 3:
+            return ['    print *, \'x += 1 ; -call y() . a.b <in> _?_\'']
+        if choice == 4:
+            return ['    do j bulk', '      do i bulk',
+                    '        state.f(i,j,1) *= 1.0_DR + 2.d-%d' % k,
+                    '      end do', '    end do']
+        if choice == 5:
+            return ['    !debugp state.step, state.f(1,1,1), "str"']
+        if choice == 6:
+            return ['    x = a.b(i).c%%d(j+%d).e + 3.14_DR - .5 + 1.e5' % k]
+        if choice == 7:
+            return ['    s //= \'abc\'  ;  n **= 2']
+        if choice == 8:
+            return ['    ==<just_once>==  ! once', '      call init()',
+                    '    ==</just_once>==']
+        if choice == 9:
+            return ['    ===<skip ctr:%d>===' % (k+1), '      call report(ctr)',
+                    '    ===</skip ctr>===']
+        if choice == 10:
+            return ['    call work(%d)  !{  %s}{lap%03d}' % (k, name[:4].rjust(4)[-4:], k % 1000)]
+        if choice == 11:
+            return ['    n = n + 1 -call state.finish()']
+        if choice == 12:
+            return ['    flag = .true. .or. (a.eq.b) .and. x.y > 1.d0']
+        if choice == 13:
+            return ['    ==<fuse i,j,k>==',
+                    '      state.f  = state.g(:,:,:)*2',
+                    '      state.f -= state.g(:,:,:) + 1',
+                    '    ==</fuse>==']
+        if choice == 14:
+            return ['    x = ' + ' + '.join('a%d.b(i)' % i for i in range(40))]
+        if choice == 15:
+            return ['    x += ' + '('*30 + 'y' + ')'*30 + ' ! ' + '+= '*20]
+        if choice == 16:
+            return ['    print *, "in __FUNC__ of __MODULE__ at __LINE__: __MODFUNC__"']
+        if choice == 17:
+            return ['    c = vect_a .dot. vect_b  ;  d = .not.e']
+        if choice == 18:
+            return ['    call sub(a, &', '             b.c, &', '             d)']
+        if choice == 19:
+            return ['    if (val /= 2) val = val - 2 ; w(1:n)%%v(%d) += 1' % k]
+        if choice == 20:
+            return ['    print *, \'it\'\'s a.b\', "q""r.s", t.u']
+        if choice == 21:
+            return ['    !!>', '      text a.b += 1', '    !!<']
+        if choice == 22:
+            return ['    if (x) return']
+        if choice == 23:
+            return ['    do i = 1, state.nx ; state.f(i,1,1) = NX ; end do']
+        if choice == 24:
+            return ['    do i = 1, min(NX, size(state.g, dim=1))', '    end do']
+        return ['    a%d.y%d = %d.10_DR' % (k, k, k)]
+
+    for s in range(rng.randrange(2, 6)):
+        sub = name + '__sub' + str(s)
+        lines.append('  subroutine ' + sub + '(state, x)')
+        lines.append('    type(' + name + '__t) <io> :: state')
+        lines.append('    real(DR) <optin> :: x')
+        lines.append('    integer(SI) <const> :: M = %d' % s)
+        lines.append('    real(DR), dimension(NX,  &')
+        lines.append('                        NY) :: work')
+        lines.append('    integer(SI) :: cells(size(state.f, dim=1), state % nx, NZ*M)')
+        for k in range(rng.randrange(5, 30)):
+            lines += statement(k)
+        lines.append('  end subroutine ' + sub)
+        lines.append('')
+    lines.append('  function ' + name + '__run(a) result(ans)')
+    lines.append('    real(DR) <in> :: a')
+    lines.append('    logical :: ans')
+    lines.append('    ans = is_ok_?_(a)')
+    lines.append('  end function ' + name + '__run')
+    lines.append('end module ' + name + '_m')
+    return '\n'.join(lines) + '\n'
+
+
+FUZZ_TOKENS = [ 'a', 'b.c', 'x(i)', 'y(:,j).z', 'abc(i+1).d', '%', '.', '(', ')', ',',
+                '3.14', '1.e-5', '.5', '2_SI', '1.0_DR', '1.d0', "'a.b += 1'", '"x!y"',
+                "'it''s'", '+=', '-=', '*=', '**=', '//=', '/=', '==', '=', '+', '-',
+                '*', '/', '//', '.and.', '.true.', '.not.', '.dot.', '!', '!debugp ',
+                ' -call ', ' <in> ', '_?_', '&', ';', '__LINE__', '__FUNC__', '<=',
+                '>=', '=>', 'if', 'call', 'print *,', '!{  main}{lap 01}', '  ', ' ' ]
+
+
+#=============================================
+def fuzzed_module(rng, n, nlines):
+#=============================================
+    lines = [ 'module fuzz' + str(n) + '_m',
+              '  implicit none',
+              'contains',
+              '  subroutine fuzz' + str(n) + '__sub' ]
+    for _ in range(nlines):
+        ntoken = rng.randrange(1, 16)
+        lines.append('    ' + ' '.join(rng.choice(FUZZ_TOKENS) for _ in range(ntoken)))
+    lines.append('  end subroutine fuzz' + str(n) + '__sub')
+    lines.append('end module fuzz' + str(n) + '_m')
+    return '\n'.join(lines) + '\n'
+
+
+#=============================================
+def make_corpora(workdir, seed, nmodules, nfuzz):
+#=============================================
+    """
+      Writes the corpora in workdir and returns
+      {corpus name: (filenames, alias_list, options, number of lines)}.
+    """
+    rng = random.Random(seed)
+    corpora = dict()
+
+    sample = os.path.join(workdir, 'sample')
+    shutil.copytree(os.path.join(HERE, 'sample_code'), sample)
+    filenames = sorted(os.path.join(sample, f) for f in os.listdir(sample) if f.endswith('.ef'))
+    corpora['sample'] = (filenames, os.path.join(sample, 'efpp_alias.list'), {})
+
+    for corpus in ('generated', 'fuzz'):
+        os.mkdir(os.path.join(workdir, corpus))
+        alias_list = os.path.join(workdir, corpus, 'efpp_alias.list')
+        with open(alias_list, 'w') as f:
+            f.write(ALIAS_LIST)
+        filenames = list()
+        if corpus == 'generated':
+            filename = os.path.join(workdir, corpus, 'constants.ef')
+            with open(filename, 'w') as f:
+                f.write(CONSTANTS)
+            filenames.append(filename)
+        count = nmodules if corpus == 'generated' else max(nfuzz // 50, 1)
+        for n in range(count):
+            filename = os.path.join(workdir, corpus, corpus + str(n) + '.ef')
+            with open(filename, 'w') as f:
+                if corpus == 'generated':
+                    f.write(generated_module(rng, n))
+                else:
+                    f.write(fuzzed_module(rng, n, 50))
+            filenames.append(filename)
+        corpora[corpus] = (filenames, alias_list, {})
+        if corpus == 'generated':
+            corpora['specialize'] = (filenames, alias_list, {'specialize': True})
+
+    ans = dict()
+    for corpus, (filenames, alias_list, options) in corpora.items():
+        nlines = 0
+        for filename in filenames:
+            with open(filename) as f:
+                nlines += len(f.readlines())
+        ans[corpus] = (filenames, alias_list, options, nlines)
+    return ans
+
+
+#=============================================
+def efpp_equiv(reference, seed, nmodules, nfuzz, tolerance, save_baseline):
+#=============================================
+    """
+      reference = git revision or file of efpp.py, or None for the
+                  frozen copy, efpp_equiv_reference.py.
+      Returns the number of the failures.
+    """
+    baseline = dict()
+    if os.path.isfile(BASELINE_FILE):
+        with open(BASELINE_FILE) as f:
+            baseline = json.load(f).get('lines_per_sec', dict())
+    try:
+        reference_source, label = engine_source(reference or REFERENCE_FILE)
+        current_source, _ = engine_source(os.path.join(HERE, 'efpp.py'))
+    except OSError as e:
+        sys.stderr.write('efpp_equiv.py: ' + str(e) + '\n')
+        sys.exit(2)
+    print('reference: ' + label)
+
+    current = load_engine(current_source, 'efpp_current')
+    frozen = load_engine(reference_source, 'efpp_reference')
+
+    failures = 0
+    measured = dict()
+    with tempfile.TemporaryDirectory() as workdir:
+        corpora = make_corpora(workdir, seed, nmodules, nfuzz)
+        print('corpus      files   lines  identical  ref(lines/s)  cur(lines/s)  baseline')
+        for corpus, (filenames, alias_list, options, nlines) in corpora.items():
+            efpp_lines = getattr(frozen, 'efpp_lines', None)
+            if options and (efpp_lines is None or
+                            any(o not in inspect.signature(efpp_lines).parameters for o in options)):
+                print('{:10s}  skipped (not in the reference)'.format(corpus))
+                continue
+            ref_results, ref_sec = run_corpus(frozen, filenames, alias_list, options)
+            cur_results, cur_sec = run_corpus(current, filenames, alias_list, options)
+
+            mismatches = [f for f in filenames if ref_results[f] != cur_results[f]]
+            ref_speed = nlines / ref_sec
+            cur_speed = nlines / cur_sec
+            measured[corpus] = round(cur_speed)
+            base = baseline.get(corpus)
+            print('{:10s} {:6d} {:7d}  {:>9s}  {:12.0f}  {:12.0f}  {:>8s}'.format(
+                  corpus, len(filenames), nlines, 'yes' if not mismatches else 'NO',
+                  ref_speed, cur_speed, str(base) if base else '-'))
+
+            for filename in mismatches[:3]:
+                print(first_difference(os.path.relpath(filename, workdir),
+                                       ref_results[filename], cur_results[filename]))
+            if mismatches:
+                failures += 1
+            if base and not save_baseline and cur_speed < base * (1 - tolerance):
+                print('  too slow: {:.0f} lines/s < {:.0f} lines/s ({:.0%} below the baseline)'.format(
+                      cur_speed, base * (1 - tolerance), tolerance))
+                failures += 1
+
+    if save_baseline:
+        with open(BASELINE_FILE, 'w') as f:
+            json.dump({'lines_per_sec': measured}, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print('baseline saved in ' + os.path.basename(BASELINE_FILE))
+        if reference:
+            with open(REFERENCE_FILE, 'w') as f:
+                f.write(reference_source)
+            print('reference frozen in ' + os.path.basename(REFERENCE_FILE))
+
+    return failures
+
+
+if __name__ == '__main__':
+
+    options = { '--reference': None, '--seed': '2018', '--modules': '200',
+                '--fuzz': '4000', '--tolerance': '0.3' }
+    save_baseline = False
+    for arg in sys.argv[1:]:
+        key, _, value = arg.partition('=')
+        if arg == '--save-baseline':
+            save_baseline = True
+        elif key in options and value:
+            options[key] = value
+        else:
+            sys.stderr.write('unknown option: ' + arg + '\n')
+            sys.exit(2)
+
+    failures = efpp_equiv(options['--reference'], int(options['--seed']),
+                          int(options['--modules']), int(options['--fuzz']),
+                          float(options['--tolerance']), save_baseline)
+    sys.exit(1 if failures else 0)
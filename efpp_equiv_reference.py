@@ -0,0 +1,2461 @@
+#!/usr/bin/env python3
+#
+#  efpp.py:
+#    Preprocessor for eFortran, a dialect of Modern Fortran.
+#
+#  History:
+#    Developed on 2017.09.17, for cg-mhd project.
+#      revised on 2018.07.13, for general eFortran codes.
+#
+#  Reference:
+#     S. Hosoyamada and A. Kageyama,
+#     "A Dialect of Modern Fortran for Simulations" '
+#     in Communications in Computer and Information Science,
+#     vol 946, pages 439-448, 2018 (Proceedings of AsiaSim2018)
+#
+#  Home page:
+#     https://github.com/akageyama/efpp
+#
+import ast
+import asyncio
+import collections
+import concurrent.futures
+import ctypes
+import ctypes.util
+import functools
+import os
+import re
+import select
+import sys
+import time
+import zlib
+
+#=============================================
+def block_comment(lines_in):
+#=============================================
+    """
+      Sample
+              input:
+                        abc def ghijklmn opq
+                        !!>
+                        abc def ghijklmn opq
+                          !!>
+                          abc def ghijklmn opq
+                          abc def ghijklmn opq
+                          !!<
+                        abc def ghijklmn opq
+                        !!<
+                        abc def ghijklmn opq
+        
+              output:
+                        abc def ghijklmn opq
+                        !!>
+                        !abc def ghijklmn opq
+                        !   !!>
+                        !!  abc def ghijklmn opq
+                        !!  abc def ghijklmn opq
+                        !   !!<
+                        !abc def ghijklmn opq
+                        !!<
+                        abc def ghijklmn opq
+    """
+    return list(block_commented(lines_in))
+
+
+#=============================================
+def block_commented(lines_in):
+#=============================================
+    """
+      Generator version of block_comment. Lines are read
+      from lines_in only when they are needed.
+    """
+    comment_depth = 0
+
+    for line in lines_in:
+        match_obj_in = re.search(r'^\s*!!>', line)
+        match_obj_out = re.search(r'^\s*!!<', line)
+        if match_obj_out:
+            comment_depth -= 1
+
+        if comment_depth>0:
+            line = re.sub(r'^', '!'*comment_depth, line)
+
+        if match_obj_in:
+            comment_depth += 1
+
+        yield line
+
+
+#=============================================
+def read_alias_list_and_make_dict(filename):
+#=============================================
+    """
+        input = file 'efpp_alias.list'
+        output = dictionary 'alias_dict'
+
+        Example:
+        --------<input>-------
+        > cat efpp_alias.list
+                 "do i bulk"  # you can separate the rule to two lines.
+              => "do i = 1 , NXPP"
+
+                 "do i full" => # you can put arrows, here, too.
+                 "do i = 0 , NXPP1"
+        --------</input>-------
+
+        --------<output>-------
+        alias_dict =  {
+            'do i bulk': 'do i = 1 , NXPP',
+            'do i full': 'do i = 0 , NXPP1'
+        }
+        --------</output>-------
+
+    """
+
+    patt_blank_line = r'^\s*$'
+       #  000  '  '  (blank line)
+    patt_comment_line = r'^\s*#.*$'
+       #  000  '# comment ...'
+    patt_both_left_and_right = r'^\s*\"(.*?)\"\s*=>\s*\"(.*?)\"\s#*.*$'
+       #  000  '" left" => " right"               '
+       #  000  '" left" => " right"  # comment ...'
+    patt_left_hand_side = r'^\s*\"(.*?)\"\s*=>\s*#*.*$'
+       #  000  '" left" =>                '
+       #  000  '" left" =>   # comment ...'
+    patt_right_hand_side = r'^\s*=>\s*\"(.*?)\"\s*#*.*$'
+       #  000   '=> " right"               '
+       #  000   '=> " right"  # comment ...'
+    patt_left_or_right = r'^\s*\"(.*?)\"\s*#*.*$'
+       #  000  '" left"                   '
+       #  000  '" left"   # comment...    '
+       #  000  '" right"                  '
+       #  000  '" right"  # comment...    '
+
+    alias_dict = dict()
+    left = ''
+    right = ''
+    with open(filename) as f:
+        for line in f:
+            m_blank_line = re.match(patt_blank_line, line)
+            m_comment_line = re.match(patt_comment_line, line)
+            m_both_left_and_right = re.match(patt_both_left_and_right, line)
+            m_left_hand_side = re.match(patt_left_hand_side, line)
+            m_right_hand_side = re.match(patt_right_hand_side, line)
+            m_left_or_right = re.match(patt_left_or_right, line)
+            if m_blank_line or m_comment_line:
+                continue
+            elif m_both_left_and_right:
+                left = m_both_left_and_right.group(1)
+                right = m_both_left_and_right.group(2)
+                alias_dict[left] = right
+                left, right='', ''
+            elif m_left_hand_side:
+                left = m_left_hand_side.group(1)
+                if right:
+                    alias_dict[left] = right
+                    left, right='', ''
+            elif m_right_hand_side:
+                right = m_right_hand_side.group(1)
+                if left:
+                    alias_dict[left] = right
+                    left, right='', ''
+            elif m_left_or_right:
+                if left != '':
+                    right = m_left_or_right.group(1)
+                else:
+                    left = m_left_or_right.group(1)
+                if left != '' and right !='':
+                    alias_dict[left] = right
+                    left, right='', ''
+            else:
+                print("error. unknown pattern.")
+                sys.exit()
+
+    return alias_dict
+
+
+alias_list_cache = dict()   # {filename: (mtime, alias_dict)}
+
+
+#=============================================
+def read_alias_list_cached(filename):
+#=============================================
+    """
+      Same as read_alias_list_and_make_dict, but the file is
+      read again only when it is updated.
+    """
+    mtime = os.stat(filename).st_mtime_ns
+    cached = alias_list_cache.get(filename)
+    if cached is None or cached[0] != mtime:
+        cached = (mtime, read_alias_list_and_make_dict(filename))
+        alias_list_cache[filename] = cached
+    return cached[1]
+
+
+#=============================================
+def lex_line(line):
+#=============================================
+    """
+      Lexical mask of a line. One character per character of the line:
+         'c' : code
+         's' : string literal (including the quotes)
+         '!' : comment
+         'n' : numeric literal
+      -------------------------------------------------------
+       x = 'a.b' + 3.14_DR  ! note
+       cccccsssssccccnnnnnnncc!!!!!!
+      -------------------------------------------------------
+    """
+    mask = list()
+    pos = 0
+    i = 0
+    n = len(line)
+    while True:
+        m = pat_lex_interesting.search(line, i)
+        if not m:
+            break
+        i = m.start()
+        c = line[i]
+        prev = line[i-1] if i > 0 else ' '
+        if c == '\'' or c == '\"':
+            j = line.find(c, i+1)
+            j = n-1 if j < 0 else j   # continued to the next line.
+            mask.append('c'*(i-pos) + 's'*(j+1-i))
+            pos = i = j+1
+        elif c == '!':
+            mask.append('c'*(i-pos) + '!'*(n-i))
+            pos = i = n
+            break
+        elif not (prev.isalnum() or prev == '_' or (c == '.' and prev == ')')):
+            j = pat_lex_number.match(line, i).end()
+            mask.append('c'*(i-pos) + 'n'*(j-i))
+            pos = i = j
+        else:
+            i += 1
+    mask.append('c'*(n-pos))
+    return ''.join(mask)
+
+
+pat_lex_interesting = re.compile(r'[\'\"!0-9]|\.[0-9]')
+pat_lex_number = re.compile(r'(\d+(\.(?![a-zA-Z]+\.)\d*)?|\.\d+)([eEdD][\+\-]?\d+)?(_\w+)?')
+
+LEXICAL_MASK_CACHE_SIZE = 8192
+lexical_mask_cache = dict()
+
+
+#=============================================
+def lexical_mask(line):
+#=============================================
+    """
+      Cached version of lex_line. All the decoders ask for the
+      mask of a line here, so that a line is lexed only once
+      while it passes through the decoders unchanged.
+    """
+    mask = lexical_mask_cache.get(line)
+    if mask is None:
+        mask = lex_line(line)
+        remember_lexical_mask(line, mask)
+    return mask
+
+
+#=============================================
+def remember_lexical_mask(line, mask):
+#=============================================
+    if len(lexical_mask_cache) >= LEXICAL_MASK_CACHE_SIZE:
+        del lexical_mask_cache[next(iter(lexical_mask_cache))]  # oldest
+    lexical_mask_cache[line] = mask
+
+
+#=============================================
+def code_end(mask):
+#=============================================
+    """
+      Position where the trailing comment starts (or the length).
+    """
+    pos = mask.find('!')
+    return len(mask) if pos < 0 else pos
+
+
+#=============================================
+def replace_span(line, mask, pos_stt, pos_end, string_new):
+#=============================================
+    """
+      Replaces line[pos_stt:pos_end] by string_new and returns the
+      new line and its mask. When a piece of plain code is replaced
+      by plain code, the mask is updated incrementally, instead of
+      lexing the whole line again.
+    """
+    line_new = line[:pos_stt] + string_new + line[pos_end:]
+    edges = line[pos_stt-1:pos_stt] + string_new[:1] + string_new[-1:] + line[pos_end:pos_end+1]
+    if ( mask.count('c', pos_stt, pos_end) == pos_end - pos_stt
+         and not pat_lex_unsafe.search(string_new)
+         and not pat_lex_unsafe_edge.search(edges) ):
+        mask_new = mask[:pos_stt] + 'c'*len(string_new) + mask[pos_end:]
+        remember_lexical_mask(line_new, mask_new)
+    else:
+        mask_new = lexical_mask(line_new)
+    return line_new, mask_new
+
+
+pat_lex_unsafe = re.compile(r'[\'\"!0-9]')
+pat_lex_unsafe_edge = re.compile(r'[0-9.]')
+
+
+#=============================================
+def replace_period_in_member_accessor(string_in):
+#=============================================
+    """
+      -------------------------------+------------------------------
+       Replace from                  |   to
+      -------------------------------+------------------------------
+       call abc.def.g(f)            ==>  call abc%def%g(f)
+       call abc(:).def( 3 ).g(f)    ==>  call abc(:)%def( 3 )%g(f)
+       call abc(i).def.g(f)         ==>  call abc(i)%def%g(f)
+       call abc(i).def(3).g(f)      ==>  call abc(i)%def(3)%g(f)
+       call abc(i ).def(:).g(f)     ==>  call abc(i )%def(:)%g(f)
+       call abc(i+1).def(:).g(f)    ==>  call abc(i+1)%def(:)%g(f)
+       call abc(i-1).def(:).g(f)    ==>  call abc(i-1)%def(:)%g(f)
+       call abc( i-1).def(:).g(f)   ==>  call abc( i-1)%def(:)%g(f)
+       call abc( i-1 ).def(:).g(f)  ==>  call abc( i-1 )%def(:)%g(f)
+      -------------------------------+------------------------------
+
+       In Fortran, "Dot" is used in 
+          (1) logical operators ".and." and ".or."
+          (2) Decimal point numbers, e.g., 3.14 or 1.23e-4
+          (3) User-defined operators, say, ".curl.", ".dot.", etc.
+          (4) Text in comments
+       They should be unchanged.
+
+      -------------------------------+------------------------------
+       if ( cond01 .and. cond02 )  ==> if ( cond01 .and. cond02 )
+                   3.14 + 1.23e-4  ==> 3.14 + 1.23e-4
+            vect_a .dot. vect_b    ==> vect_a .dot. vect_b
+                     "Like this."  ==>  "Like this."  
+              '... or like this.'  ==>  '... or like this.'
+      --------------------------------------------------------------
+
+
+      Strings, comments and numbers are found in the lexical mask.
+      In the code part, a period is a member-accessor if it sits
+      between a name (or ')') and a name, unless it is a part of
+      an operator: ".and.", ".true.", etc., or ".xyz." separated
+      from the operands, as in "a .dot. b" and "routine(.abc.)".
+    """
+    mask = lexical_mask(string_in)
+    char_list = None
+    i = string_in.find('.')
+    while i >= 0:
+        if mask[i] != 'c':
+            i = string_in.find('.', i+1)
+            continue
+        prev = string_in[i-1] if i > 0 else ' '
+        prev_is_operand = prev.isalnum() or prev == '_' or prev == ')'
+        m = pat_dot_operator.match(string_in, i)
+        if m and ( m.group(1).lower() in intrinsic_dot_operators
+                   or not prev_is_operand ):
+            i = string_in.find('.', m.end())
+            continue
+        if prev_is_operand and string_in[i+1:i+2].isalpha():
+            if char_list is None:
+                char_list = list(string_in)
+            char_list[i] = '%'
+        i = string_in.find('.', i+1)
+
+    if char_list is None:
+        return string_in
+    return ''.join(char_list)
+
+
+pat_dot_operator = re.compile(r'\.([a-zA-Z][a-zA-Z_0-9]*)\.')
+intrinsic_dot_operators = ('and', 'or', 'not', 'eqv', 'neqv', 'true', 'false',
+                           'eq', 'ne', 'lt', 'le', 'gt', 'ge')
+
+
+#=============================================
+def alias_decode(alias_list, lines_in):
+#=============================================
+    """
+    Converts strings. The rule is defined in alias_dict, which
+    is constructed from a source text named 'efpp_alias.list'.
+
+    ====<sample of alias_dict>====
+        alias_dict = {
+            "type(sfield_t)"
+          : "real(DR), dimension(0:NXPP1,0:NYPP1,0:NZPP1)"
+          ,
+            "do i bulk"
+          : "do i = 1 , NXPP"
+          ,
+            "do i full"
+          : "do i = 0 , NXPP1"
+          ,
+            "do j bulk"
+          : "do j = 1 , NYPP"
+          ,
+            "do j full"
+          : "do j = 0 , NYPP1"
+          ,
+            "do k bulk"
+          : "do k = 1 , NZPP"
+          ,
+            "do k full"
+          : "do k = 0 , NZPP1"
+        }
+    ====</sample of alias_dict>====
+
+    ====<source of the above: efpp_alias.list>====
+
+        # since there is no typedef in fortran.
+             "type(sfield_t)"
+          => "real(DR), dimension(0:NXPP1,0:NYPP1,0:NZPP1)"
+
+             "do i bulk"  # special macro in this code.
+          => "do i = 1 , NXPP"
+
+             "do i full" =>
+             "do i = 0 , NXPP1"
+
+             "do j bulk" =>
+             "do j = 1 , NYPP"
+
+             "do j full" =>
+             "do j = 0 , NYPP1"
+
+             "do k bulk"
+          => "do k = 1 , NZPP"
+
+             "do k full"
+          => "do k = 0 , NZPP1"
+
+    ====</source of the above: efpp_alias.list>====
+
+    """
+    alias_dict = make_alias_dict(alias_list)
+
+    output = list()
+    for line in lines_in:
+        output.append(alias_decode_line(alias_dict, line))
+
+    return output
+
+
+#=============================================
+def make_alias_dict(alias_list):
+#=============================================
+    # Default macros
+    alias_dict = {
+            "_?_"
+          : "_BOOLEAN"
+          ,
+            " char(len="
+          : " character(len="
+          ,
+            " <in> "
+          : ", intent(in) "
+          ,
+            " <out> "
+          : ", intent(out) "
+          ,
+            " <io> "
+          : ", intent(inout) "
+          ,
+            " <optin> "
+          : ", intent(in), optional "
+          ,
+            " <optout> "
+          : ", intent(out), optional "
+          ,
+            " <optio> "
+          : ", intent(inout), optional "
+          ,
+            " <const> "
+          : ", parameter "
+        }
+
+    # Append user-defined macros
+    alias_dict.update(read_alias_list_cached(alias_list))
+
+    return alias_dict
+
+
+#=============================================
+def alias_decode_line(alias_dict, line):
+#=============================================
+    for i in alias_dict:
+        if i in line:
+            line = alias_replace(line, i, alias_dict[i])
+    return line
+
+
+#=============================================
+def alias_replace(line, alias, replaced):
+#=============================================
+    """
+      Replaces the alias in the code part of the line. Strings
+      and comments are left unchanged, except for
+        (1) macro names like "__EFPPVER__", which are replaced
+            everywhere, as __FUNC__ and __LINE__ are, and
+        (2) aliases starting with '!', like "!debugp ", which
+            are replaced at the beginning of a comment.
+    """
+    anywhere = pat_alias_macro_name.match(alias)
+    mask = lexical_mask(line)
+    pos = line.find(alias)
+    while pos >= 0:
+        end = pos + len(alias)
+        if alias[0] == '!':
+            ok = mask[pos] == '!' and (pos == 0 or mask[pos-1] != '!')
+        else:
+            ok = anywhere or (mask[pos] in 'cn' and mask[end-1] in 'cn')
+        if ok:
+            line, mask = replace_span(line, mask, pos, end, replaced)
+            pos = line.find(alias, pos + len(replaced))
+        else:
+            pos = line.find(alias, pos + 1)
+    return line
+
+
+pat_alias_macro_name = re.compile(r'^__\w+__$')
+
+#=============================================
+def subsdiary_call_decode(lines_in):
+#=============================================
+    """
+       xyz -call abc()  =>  xyz ;call abc()
+           -call abc()  =>       call abc()
+    """
+    output = list()
+    pat = re.compile(r' -call +(?=[a-zA-Z])')
+
+    for line in lines_in:
+        match = None
+        if ' -call ' in line:
+            mask = lexical_mask(line)
+            for m in pat.finditer(line):   # the last one in code.
+                if mask[m.start()+1] == 'c':
+                    match = m
+        if match:
+            s = line[:match.start()]
+            if re.search(r'^\s*$', s):
+                s += '  call '
+            else:
+                s += ' ;call '
+            s += line[match.end():].rstrip('\n')
+            s += '\n'
+            output.append(s)
+        else:
+            output.append(line)
+
+    return output
+
+
+#=============================================
+def just_once_region(lines_in):
+#=============================================
+    """
+       program test
+         logical :: just_once = .true.
+         ==<just_once>==    ! you can put comment here.
+           call subsub('asdfasdf')
+         ==</just_once>==   ! end of just_once region.
+       end program test
+    """
+    output = list()
+    pat_begin = re.compile(r'^([^=]+)=+<just_once>=+(.*)$')
+    pat_end = re.compile(r'^([^=]+)=+</just_once>=+(.*)$')
+
+    for line in lines_in:
+        match_begin = pat_begin.search(line)
+        match_end = pat_end.search(line)
+        if match_begin:
+            s = match_begin.group(1)
+            s += 'if (just_once) then'
+            s += ' ' + match_begin.group(2)
+            s += '\n'
+        elif match_end:
+            s = match_end.group(1)
+            s += 'just_once = .false. ; end if'
+            s += ' ' + match_end.group(2)
+            s += '\n'
+        else:
+            s = line
+        output.append(s)
+
+    return output
+
+
+#=============================================
+def skip_counter(lines_in):
+#=============================================
+    """
+        # program test
+        #   inte(SI) :: ctr=0
+        #   inte(SI) :: i
+        #   do i = 1 , 200
+        #     ===<skip ctr:8>===  ! you can put comment.
+        #       call subsub('asdfasdf',i)
+        #     ===</skip ctr>===   ! end of skip block.
+        #   end do
+        # end program test
+    """
+    output = list()
+    pat_begin = re.compile(r'^([^=]+)=+<skip\s+([a-zA-Z][a-zA-Z_0-9]*):(\s*.+)>=+(.*)$')
+    pat_end = re.compile(r'^([^=]+)=+</skip\s+([a-zA-Z][a-zA-Z_0-9]*)>=+(.*)$')
+
+    for line in lines_in:
+        match_begin = pat_begin.search(line)
+        match_end = pat_end.search(line)
+        if match_begin:
+            s = match_begin.group(1)
+            s += 'if(mod(' + match_begin.group(2)
+            s += ',' + match_begin.group(3)
+            s += ')==0) then' + match_begin.group(4)
+            s += '\n'
+        elif match_end:
+            s = match_end.group(1)
+            s += 'end if; '
+            s += match_end.group(2) + ' = '
+            s += match_end.group(2) + ' + 1'
+            s += ' ' + match_end.group(3)
+            s += '\n'
+        else:
+            s = line
+        output.append(s)
+
+    return output
+
+
+#=============================================
+def split_at_top_level_commas(string_in):
+#=============================================
+    """
+      'i=1:size(a,1), j'  ==>  ['i=1:size(a,1)', ' j']
+    """
+    items = list()
+    depth = 0
+    item = ''
+    for c in string_in:
+        if c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+        if c == ',' and depth == 0:
+            items.append(item)
+            item = ''
+        else:
+            item += c
+    items.append(item)
+    return items
+
+
+#=============================================
+def fused_array_assignment(line, indices, lhs_names):
+#=============================================
+    """
+      Rewrite one whole-array assignment in a fusion block into
+      its element-wise form. (indices = ['i','j','k'])
+
+        operator_dot_product += a.y(:,:,:)*b.y(:,:,:)
+      ==>
+        operator_dot_product(i,j,k) = operator_dot_product(i,j,k) + (a.y(i,j,k)*b.y(i,j,k))
+
+      Bare names in lhs_names (arrays assigned in the block) and
+      all-colon sections get subscripted; anything else is left as it
+      is. They must not be arguments of a function other than
+      elemental intrinsics, since sum(b(:,:)) is not sum(b(i,j)).
+      Arrays in lhs_names must not be referred to with other subscripts,
+      since a(1,1) would be read in the loop after it is assigned.
+    """
+    rank = len(indices)
+    subscript = '(' + ','.join(indices) + ')'
+
+    pat_ref = re.compile(r'(?<![\w.%])([a-zA-Z]\w*(?:[.%][a-zA-Z]\w*)*)'
+                         r'(\s*\(\s*:\s*(?:,\s*:\s*)*\))?')
+
+    def index_ref(m):
+        name, section = m.group(1), m.group(2)
+        if lexical_mask(m.string)[m.start()] != 'c':
+            return m.group(0)   # in a string.
+        following = m.string[m.end():].lstrip()
+        if not section and name in lhs_names and following.startswith('('):
+            raise ValueError(name + following[:following.find(')')+1]
+                             + ' refers to an array assigned in the block'
+                             + ' by other than (' + ','.join([':']*rank) + ')')
+        if not section and name not in lhs_names:
+            return m.group(0)
+        if section and section.count(':') != rank:
+            raise ValueError('rank of ' + name + section + ' is not ' + str(rank))
+        function = enclosing_function(m.string, m.start())
+        if function and function.lower() not in elemental_intrinsics:
+            raise ValueError(name + (section or '') + ' in ' + function
+                             + '(), which is not an elemental intrinsic')
+        return name + subscript
+
+    line = line.rstrip('\n')
+    pos = code_end(lexical_mask(line))
+    code, comment = line[:pos], line[pos:]
+    m = re.match(r'^(\s*)([a-zA-Z]\w*(?:[.%][a-zA-Z]\w*)*)'
+                 r'(\s*\(\s*:\s*(?:,\s*:\s*)*\))?\s*([\+\-\*]?)=(?!=)\s*(.+?)\s*$', code)
+    if not m:
+        raise ValueError('not a whole-array assignment')
+
+    lhs = pat_ref.sub(index_ref, m.group(2) + (m.group(3) or ''))
+    rhs = pat_ref.sub(index_ref, m.group(5))
+    s = m.group(1) + lhs + ' = '
+    if m.group(4):
+        s += lhs + ' ' + m.group(4) + ' (' + rhs + ')'
+    else:
+        s += rhs
+    if comment:
+        s += '  ' + comment
+    return s + '\n'
+
+
+#=============================================
+def enclosing_function(string_in, pos):
+#=============================================
+    """
+      Name of the function (or array) whose argument list encloses
+      string_in[pos], e.g., 'sum' for pos at 'b' in "2*sum(b(:,:))",
+      or '' if pos is not in an argument list.
+    """
+    mask = lexical_mask(string_in)
+    depth = 0
+    for i in range(pos-1, -1, -1):
+        if mask[i] != 'c':
+            continue
+        if string_in[i] == ')':
+            depth += 1
+        elif string_in[i] == '(':
+            if depth == 0:
+                m = re.search(r'([a-zA-Z]\w*)\s*$', string_in[:i])
+                if m:
+                    return m.group(1)
+            else:
+                depth -= 1
+    return ''
+
+
+elemental_intrinsics = ('abs', 'sqrt', 'exp', 'log', 'log10', 'sin', 'cos', 'tan',
+                        'asin', 'acos', 'atan', 'atan2', 'sinh', 'cosh', 'tanh',
+                        'max', 'min', 'mod', 'modulo', 'sign', 'dim', 'real', 'dble',
+                        'int', 'nint', 'floor', 'ceiling', 'aimag', 'conjg', 'cmplx',
+                        'merge', 'erf', 'gamma', 'hypot')
+
+
+#=============================================
+def array_fusion_block(filename_in, lines_in):
+#=============================================
+    """
+         ==<fuse i=1:GRID_NX, j=1:GRID_NY, k=1:GRID_NZ>==
+           operator_dot_product  = a.x(:,:,:)*b.x(:,:,:)
+           operator_dot_product += a.y(:,:,:)*b.y(:,:,:)
+           operator_dot_product += a.z(:,:,:)*b.z(:,:,:)
+         ==</fuse>==
+       ==>
+         do k = 1, GRID_NZ ; do j = 1, GRID_NY ; do i = 1, GRID_NX
+           operator_dot_product(i,j,k) = a.x(i,j,k)*b.x(i,j,k)
+           operator_dot_product(i,j,k) = operator_dot_product(i,j,k) + (a.y(i,j,k)*b.y(i,j,k))
+           operator_dot_product(i,j,k) = operator_dot_product(i,j,k) + (a.z(i,j,k)*b.z(i,j,k))
+         end do ; end do ; end do
+
+       The whole-array assignments (=, +=, -=, *=) in the block are
+       fused into a single loop nest, so that the arrays are traversed
+       only once. The index variables (i,j,k) must be declared by the
+       user. When the range of an index is omitted, as in "==<fuse i,j,k>==",
+       lbound and ubound of the first left hand side are used; mind the
+       132 column limit then. Line numbers are kept unchanged.
+    """
+    output = list()
+    pat_begin = re.compile(r'^([^=]+)=+<fuse\s+([^>]+)>=+(.*)$')
+    pat_end = re.compile(r'^([^=]+)=+</fuse>=+(.*)$')
+    pat_lhs = re.compile(r'^\s*([a-zA-Z]\w*(?:[.%][a-zA-Z]\w*)*)\s*(\()?')
+    pat_skip = re.compile(r'^\s*(!.*)?$')
+
+    def error(lctr, message):
+        sys.stderr.write('Error in '+filename_in+'('+str(lctr)+'): '+message+'\n')
+        sys.exit(1)
+
+    lctr = 0
+    block = None
+    for line in lines_in:
+        lctr += 1
+        match_begin = pat_begin.search(line)
+        match_end = pat_end.search(line)
+        if match_begin:
+            if block is not None:
+                error(lctr, 'nested fuse block')
+            block = [(lctr, match_begin, line)]
+        elif match_end:
+            if block is None:
+                error(lctr, 'fuse block end without begin')
+            block.append((lctr, match_end, line))
+            output += fuse_block_lines(block, pat_lhs, pat_skip, error)
+            block = None
+        elif block is not None:
+            block.append((lctr, None, line))
+        else:
+            output.append(line)
+
+    if block is not None:
+        error(block[0][0], 'fuse block is not closed')
+
+    return output
+
+
+#=============================================
+def fuse_block_lines(block, pat_lhs, pat_skip, error):
+#=============================================
+    lctr_begin, match_begin, _ = block[0]
+    _, match_end, _ = block[-1]
+    body = block[1:-1]
+
+    indices = list()
+    ranges = list()
+    for item in split_at_top_level_commas(match_begin.group(2)):
+        m = re.match(r'^\s*([a-zA-Z]\w*)\s*(?:=\s*(.+?)\s*:\s*(.+?))?\s*$', item)
+        if not m:
+            error(lctr_begin, 'bad fuse index "' + item.strip() + '"')
+        indices.append(m.group(1))
+        ranges.append((m.group(2), m.group(3)))
+
+    first = None
+    lhs_names = set()
+    for lctr, _, line in body:
+        if pat_skip.search(line):
+            continue
+        m = pat_lhs.search(line)
+        if not m:
+            error(lctr, 'in fuse block, not a whole-array assignment')
+        if first is None:
+            first = m
+        lhs_names.add(m.group(1))
+    if first is None:
+        error(lctr_begin, 'empty fuse block')
+
+    loops = list()
+    for dim in range(len(indices), 0, -1):
+        lower, upper = ranges[dim-1]
+        if lower is None:
+            lower = 'lbound(' + first.group(1) + ',' + str(dim) + ')'
+            upper = 'ubound(' + first.group(1) + ',' + str(dim) + ')'
+        loops.append('do ' + indices[dim-1] + ' = ' + lower + ', ' + upper)
+
+    output = list()
+    output.append(match_begin.group(1) + ' ; '.join(loops) + ' ' + match_begin.group(3) + '\n')
+    for lctr, _, line in body:
+        if pat_skip.search(line):
+            output.append(line)
+            continue
+        try:
+            output.append(fused_array_assignment(line, indices, lhs_names))
+        except ValueError as e:
+            error(lctr, 'in fuse block, ' + str(e))
+    output.append(match_end.group(1) + ' ; '.join(['end do']*len(indices))
+                  + ' ' + match_end.group(2) + '\n')
+    return output
+
+
+#=============================================
+def routine_name_macro(lines_in):
+#=============================================
+    """
+         module test_m ! <= Count this 'module'
+           interface gen
+             module procedure ... ! <= Do not count
+                                  !    this as a 'module'
+           end interface
+           ..
+         contains
+           subroutine test__sub ! <= Count this as a 'subroutine'
+           end subroutine test__sub
+         end module test_m
+
+         program main0 ! <= Count this as a 'program'
+          ..
+         contains
+           subroutine sub1(...) ! <= Count this as a 'subroutine'
+           contains
+             function fun2(...) ! <= Count this as a 'function'
+               print('__MODFUNC__')   ! print('main0/sub1/fun2')
+             end function fun2
+           end subroutine sub1
+         end program main0
+    """
+    output = list()
+
+    lctr = 0  # line counter
+    for line, _, name, _ in routine_name_scopes(lines_in):
+        lctr += 1
+
+        if len(name)>0:
+            progmodule_name = name[0]
+            line = line.replace('__MODULE__', progmodule_name)
+            module_plus_linenum =  progmodule_name + '(' + str(lctr) + ')'
+            line = line.replace('__MODLINE__', module_plus_linenum )
+        if len(name)==3:
+            subroufunc_name = name[1] + '/' + name[2]
+            line = line.replace('__FUNC__', subroufunc_name)
+            module_plus_subroufunc_name = progmodule_name + '/' + subroufunc_name
+            line = line.replace('__MODFUNC__', module_plus_subroufunc_name)
+        elif len(name)==2:
+            subroufunc_name = name[1]
+            line = line.replace('__FUNC__', subroufunc_name)
+            module_plus_subroufunc_name = progmodule_name + '/' + subroufunc_name
+            line = line.replace('__MODFUNC__', module_plus_subroufunc_name)
+
+        line = line.replace('__LINE__', str(lctr))
+
+        output.append(line)
+
+    return output
+
+
+#=============================================
+def routine_name_scopes(lines_in):
+#=============================================
+    """
+      Yields (line, name_before, name, kind) for each line, where
+      'name' is the stack of the program/module/subroutine/function
+      names after the line, e.g., ('main0', 'sub1', 'fun2'), and
+      'name_before' is that before the line. 'kind' is the stack
+      of 'program', 'module', 'subroutine', 'function', or 'pure'
+      (for pure or elemental subprograms).
+    """
+    this_line_is_in_interface = False
+    pat_program_in = re.compile(r'^(\s*)program\s+([a-zA-Z][a-zA-Z_0-9]*)\s+')
+    pat_module_in = re.compile(r'^(\s*)module\s+([a-zA-Z][a-zA-Z_0-9]*)\s+')
+    pat_subroufunc_in = re.compile(r'^(\s*)((?:(?:elemental|pure|impure|recursive)\s+)*'
+                                   r'(?:(?:integer|real|logical|complex|character|type|class)'
+                                   r'(?:\s*\([^)]*\))?\s+)?)'
+                                   r'(subroutine|function)\s+([a-zA-Z][a-zA-Z_0-9]*)[\s\(].*')
+    pat_interface_in = re.compile(r'^(\s*)interface\s+[a-zA-Z][a-zA-Z_0-9]*')
+    pat_pure = re.compile(r'(?<!im)(pure|elemental)\s')
+
+    pat_program_out = re.compile(r'^(\s*)end\s+program\s+[a-zA-Z][a-zA-Z_0-9]*')
+    pat_module_out = re.compile(r'^(\s*)end\s+module\s+[a-zA-Z][a-zA-Z_0-9]*')
+    pat_subroufunc_out = re.compile(r'^(\s*)end\s+(subroutine|function)\s+[a-zA-Z][a-zA-Z_0-9]*')
+    pat_interface_out = re.compile(r'^(\s*)end\s+interface')
+
+    name = list()
+    kind = list()
+    for line in lines_in:
+        name_before = tuple(name)
+        match_program_in = pat_program_in.search(line)
+        match_module_in = pat_module_in.search(line)
+        match_subroufunc_in = pat_subroufunc_in.search(line)
+        match_interface_in = pat_interface_in.search(line)
+        match_program_out = pat_program_out.search(line)
+        match_module_out = pat_module_out.search(line)
+        match_subroufunc_out = pat_subroufunc_out.search(line)
+        match_interface_out = pat_interface_out.search(line)
+
+        if match_program_in:
+            name.append(match_program_in.group(2))
+            kind.append('program')
+
+        if match_interface_in:
+            this_line_is_in_interface = True
+        if match_interface_out:
+            this_line_is_in_interface = False
+
+        if match_module_in:
+            if not this_line_is_in_interface:
+                name.append(match_module_in.group(2))
+                kind.append('module')
+        if match_subroufunc_in:
+            name.append(match_subroufunc_in.group(4))
+            if pat_pure.search(match_subroufunc_in.group(2)):
+                kind.append('pure')
+            else:
+                kind.append(match_subroufunc_in.group(3))
+        if match_program_out or match_module_out or match_subroufunc_out:
+            name.pop()
+            kind.pop()
+
+        yield line, name_before, tuple(name), tuple(kind)
+
+
+#=============================================
+def instrument_routines(lines_in, timer=False):
+#=============================================
+    """
+      efpp.py --instrument       (counters)
+      efpp.py --instrument=time  (counters and timers)
+
+         module vecfield_m
+           ..
+         contains
+           subroutine vecfield__init(a)
+             type(vecfield__t), intent(out) :: a
+             a%x(:,:,:) = 1.0_DR
+           end subroutine vecfield__init
+         end module vecfield_m
+      ==>
+         module vecfield_m ; use efpp_profile_m
+           ..
+         contains
+           subroutine vecfield__init(a)
+             type(vecfield__t), intent(out) :: a
+             call efpp_profile__enter(123456789,'vecfield_m/vecfield__init') ; a%x(:,:,:) = 1.0_DR
+           call efpp_profile__leave(123456789) ; end subroutine vecfield__init
+         end module vecfield_m
+
+      The entry call is put on the first executable line of every
+      subroutine and function, found with the same name tracking
+      as routine_name_macro. With timers, the exit call is put on
+      'return', 'contains', and 'end subroutine/function' lines.
+      The number is a hash of the 'module/sub' path. The profile is
+      dumped when the main program reaches 'end program' (or its
+      'contains'). Pure and elemental procedures are not instrumented.
+      cpp lines (#ifdef, etc.) are skipped as blank lines are, and the
+      entry call is not put in an #if block, which may be compiled out.
+      Line numbers are kept unchanged.
+
+      efpp_profile_m is defined in efpp_profile.f90.
+    """
+    pat_blank = re.compile(r'^\s*$')
+    pat_cpp = re.compile(r'^\s*#\s*(\w*)')
+    pat_interface_in = re.compile(r'^\s*(abstract\s+)?interface\b')
+    pat_interface_out = re.compile(r'^\s*end\s+interface')
+    pat_type_in = re.compile(r'^\s*type\s*(,.*::|::)?\s*[a-zA-Z]\w*\s*$')
+    pat_type_out = re.compile(r'^\s*end\s+type')
+    pat_contains = re.compile(r'^\s*contains\s*$')
+    pat_return = re.compile(r'^(\s*)return\s*$')
+    pat_if_return = re.compile(r'^(\s*)(if\s*\(.*\))\s*return\s*$')
+    pat_spec = re.compile(r'^\s*(use|implicit|integer|real|double|complex|logical'
+                          r'|character|type|class|procedure|dimension|parameter'
+                          r'|intent|optional|save|external|intrinsic|data|namelist'
+                          r'|common|equivalence|import|pointer|target|allocatable'
+                          r'|private|public|contiguous|volatile|asynchronous|value'
+                          r'|protected|format|include)\b')
+
+    def prefix(line, text):
+        indent = line[:len(line) - len(line.lstrip())]
+        return indent + text + ' ; ' + line.lstrip()
+
+    output = list()
+    units = list()     # [[line index of the end of the header, instrumented], ...]
+    frames = list()    # [[kind, path, key, state], ...]
+    in_interface = 0
+    in_type = 0
+    in_cpp_if = 0
+    continued = False
+
+    for line, name_before, name, kind in routine_name_scopes(lines_in):
+        match_cpp = pat_cpp.search(line)
+        if match_cpp:
+            if match_cpp.group(1) in ('if','ifdef','ifndef'):
+                in_cpp_if += 1
+            elif match_cpp.group(1) == 'endif':
+                in_cpp_if = max(in_cpp_if - 1, 0)
+            output.append(line)
+            continue
+        mask = lexical_mask(line)
+        code = line[:code_end(mask)].rstrip()
+        this_line_is_continued = code.endswith('&')
+        this_is_a_new_statement = not continued
+        continued = this_line_is_continued
+        match_interface_in = pat_interface_in.search(code)
+        match_interface_out = pat_interface_out.search(code)
+        if match_interface_in:
+            in_interface += 1
+
+        if len(name) > len(name_before):
+            path = '/'.join(name)
+            key = (zlib.crc32(path.encode()) & 0x7fffffff) or 1
+            k = kind[-1]
+            if in_interface:
+                k = 'interface'
+            frames.append([k, path, key, 'header'])
+            if len(name) == 1:
+                units.append([-1, False])
+        elif len(name) < len(name_before):
+            k, path, key, state = frames.pop()
+            if k in ('subroutine','function'):
+                if state == 'spec':
+                    enter = 'efpp_profile__enter' if timer else 'efpp_profile__count'
+                    text = 'call ' + enter + '(' + str(key) + ",'" + path + "')"
+                    if timer:
+                        text += ' ; call efpp_profile__leave(' + str(key) + ')'
+                    line = prefix(line, text)
+                    units[-1][1] = True
+                elif state == 'body' and timer:
+                    line = prefix(line, 'call efpp_profile__leave(' + str(key) + ')')
+            elif k == 'program' and state in ('spec','body'):
+                line = prefix(line, 'call efpp_profile__dump()')
+                units[-1][1] = True
+            output.append(line)
+            continue
+
+        if match_interface_out:
+            in_interface -= 1
+        if not frames:
+            output.append(line)
+            continue
+        frame = frames[-1]
+        k, path, key, state = frame
+
+        if state == 'header':
+            if not this_line_is_continued:
+                frame[3] = 'spec'
+                if len(frames) == 1:
+                    units[-1][0] = len(output)
+        elif k in ('module','pure','interface'):
+            pass
+        elif in_interface or match_interface_out:
+            pass
+        elif pat_type_in.search(code) or in_type:
+            in_type += 1 if pat_type_in.search(code) else 0
+            in_type -= 1 if pat_type_out.search(code) else 0
+        elif not this_is_a_new_statement or pat_blank.search(code):
+            pass
+        elif state == 'spec' and (pat_spec.search(code) or in_cpp_if):
+            pass
+        elif k == 'program':
+            if state == 'spec':
+                frame[3] = 'body'
+            if pat_contains.search(code):
+                line = prefix(line, 'call efpp_profile__dump()')
+                units[-1][1] = True
+                frame[3] = 'contained'
+        elif state in ('spec','body'):
+            text = ''
+            if state == 'spec':
+                enter = 'efpp_profile__enter' if timer else 'efpp_profile__count'
+                text = 'call ' + enter + '(' + str(key) + ",'" + path + "')"
+                frame[3] = 'body'
+                units[-1][1] = True
+            if timer and pat_contains.search(code):
+                text += (' ; ' if text else '') + 'call efpp_profile__leave(' + str(key) + ')'
+            if pat_contains.search(code):
+                frame[3] = 'contained'
+            m = pat_if_return.search(code)
+            if timer and m:
+                leave = 'call efpp_profile__leave(' + str(key) + ')'
+                line = (m.group(1) + m.group(2) + ' then ; ' + leave + ' ; return ; end if'
+                        + line[len(code):])
+            elif timer and pat_return.search(code):
+                text += (' ; ' if text else '') + 'call efpp_profile__leave(' + str(key) + ')'
+            if text:
+                line = prefix(line, text)
+
+        output.append(line)
+
+    for use_line, instrumented in units:
+        if instrumented and use_line >= 0:
+            line = output[use_line]
+            pos = len(line[:code_end(lexical_mask(line))].rstrip())
+            output[use_line] = line[:pos] + ' ; use efpp_profile_m' + line[pos:]
+
+    return output
+
+
+#=============================================
+def const_bound_macro(filename_in, alias_list, lines_in):
+#=============================================
+    """
+      efpp.py --specialize
+
+      Integer parameters in loop bounds and array shapes are
+      replaced by their values. With
+
+          integer(SI) <const> :: GRID_NX = 10     (in constants.ef)
+
+      "do i = 1 , GRID_NX"                 =>  "do i = 1 , 10"
+      "real(DR) :: x(GRID_NX,GRID_NY)"     =>  "real(DR) :: x(10,12)"
+      "real(DR), dimension(GRID_NX) :: a"  =>  "real(DR), dimension(10) :: a"
+
+      so that the compiler sees the fixed extents. This is applied
+      to the converted lines, so the loops made by the aliases and
+      the fuse blocks are included. The values are taken from the
+      file and the modules it uses; see const_tables. Only "do"
+      statements and the shapes in declarations are changed, not
+      the initial values.
+    """
+    tables = const_tables(filename_in, alias_list, lines_in)
+
+    output = list()
+    state = None
+    for line, _, name, _ in routine_name_scopes(lines_in):
+        table = tables.get(tuple(n.lower() for n in name))
+        mask = lexical_mask(line)
+        spans, state = const_bound_spans(line, mask, state)
+        for pos_stt, pos_end in reversed(spans):
+            value = table.get(line[pos_stt:pos_end].lower()) if table else None
+            if value is not None:
+                literal = str(value) if value >= 0 else '(' + str(value) + ')'
+                line, mask = replace_span(line, mask, pos_stt, pos_end, literal)
+        output.append(line)
+
+    return output
+
+
+#=============================================
+def const_bound_spans(line, mask, state):
+#=============================================
+    """
+      Returns the spans of the names that are bounds or shapes:
+      names in a "do" statement, in "dimension(...)" of a declaration,
+      and in the shapes of the declared entities,
+
+        real(DR), dimension(NX,NY) :: a, b(NZ) = reshape(c, [NX*NY*NZ])
+                            ^^ ^^       ^^
+
+      and the state of the statement, which is passed to the next
+      line when the statement is continued by '&' (otherwise None).
+      Components (g%nx) and keyword arguments (size(a, dim=1)) are
+      not names of parameters, and are skipped.
+    """
+    spans = list()
+    for match in pat_const_bound_token.finditer(line):
+        if mask[match.start()] != 'c':
+            continue
+        token = match.group().lower()
+        if state is None:   # the first token of a statement.
+            kind = 'do' if token == 'do' else 'decl' if token in const_bound_decl_types else 'other'
+            state = dict(kind=kind, depth=0, dim=(token=='dimension'), entity=False, init=False)
+        elif token == ';' and state['depth'] == 0:
+            state = None
+        elif token == '(':
+            state['depth'] += 1
+        elif token == ')':
+            state['depth'] -= 1
+            if state['depth'] == 0:
+                state['dim'] = False
+        elif state['kind'] == 'decl' and state['depth'] == 0:
+            if token == 'dimension':
+                state['dim'] = True
+            elif token == '::':
+                state['entity'] = True
+            elif token in ('=', '=>') and state['entity']:
+                state['init'] = True    # initial value
+            elif token == ',' and state['entity']:
+                state['init'] = False   # next entity
+        elif token[0].isalpha():
+            if line[:match.start()].rstrip().endswith('%'):
+                continue   # component
+            if state['depth'] > 0 and pat_const_bound_keyword.match(line, match.end()):
+                continue   # keyword argument
+            if ( state['kind'] == 'do'
+                 or ( state['kind'] == 'decl'
+                      and (state['dim'] or (state['entity'] and not state['init'])) ) ):
+                spans.append(match.span())
+
+    code = line[:code_end(mask)].rstrip()
+    if code and not code.endswith('&'):
+        state = None
+    return spans, state
+
+
+pat_const_bound_token = re.compile(r'[a-zA-Z]\w*|::|=>|[<>/=]=|[=(),;&]')
+pat_const_bound_keyword = re.compile(r'\s*=(?![=>])')
+const_bound_decl_types = ('integer', 'real', 'complex', 'logical', 'character',
+                          'type', 'class', 'double', 'dimension')
+
+
+#=============================================
+def const_tables(filename_in, alias_list, lines_in):
+#=============================================
+    """
+      {scope: {name: value}} of the integer parameters visible in
+      each scope (as in routine_name_scopes) of the file, e.g.,
+
+          {('constants_m',): {'si': 4, 'grid_nx': 10, ...},
+           ('main',): {'grid_nx': 10, ...}, ...}
+
+      lines_in are the converted lines, where <const> is ", parameter".
+      The used modules are looked for in the .ef and .e03 files
+      of the same directory, and evaluated before the scope that
+      uses them, following the 'use' statements (with 'only' and
+      renames). A procedure sees the parameters of its host, except
+      the names it declares itself. A parameter whose value is not
+      an integer constant expression of the known ones, such as
+      selected_int_kind(6), is not in the table. Names are in
+      lower case.
+    """
+    scopes = const_scopes(lines_in)
+
+    modules = dict()   # {module name: (scopes of the file, scope)}
+    dirname = os.path.dirname(filename_in) or '.'
+    for name in sorted(os.listdir(dirname)):
+        filename = os.path.join(dirname, name)
+        if ( name.endswith(WATCH_SUFFIXES)
+             and os.path.isfile(filename)
+             and os.path.abspath(filename) != os.path.abspath(filename_in) ):
+            others = const_scopes_cached(filename, alias_list)
+            for scope, info in others.items():
+                if info['kind'] == 'module':
+                    modules.setdefault(scope[0], (others, scope))
+    for scope, info in scopes.items():
+        if info['kind'] == 'module':
+            modules[scope[0]] = (scopes, scope)
+
+    tables = dict()    # {(id of the scopes, scope): table}
+    exports = dict()   # {module name: table}
+
+    def module_table(module):
+        if module not in exports:
+            exports[module] = dict()   # against circular 'use'.
+            if module in modules:
+                owner, scope = modules[module]
+                table = scope_table(owner, scope)
+                if owner[scope]['private']:
+                    table = {n: v for n, v in table.items() if n in owner[scope]['public']}
+                exports[module] = table
+        return exports[module]
+
+    def scope_table(owner, scope):
+        key = (id(owner), scope)
+        if key not in tables:
+            info = owner[scope]
+            table = dict()
+            if len(scope) > 1 and scope[:-1] in owner:
+                table = {n: v for n, v in scope_table(owner, scope[:-1]).items()
+                         if n not in info['locals']}
+            for module, only, renames in info['uses']:
+                imported = module_table(module)
+                if only is None:
+                    imported = dict(imported)
+                    for local, remote in renames:
+                        if remote in imported:
+                            imported[local] = imported.pop(remote)
+                else:
+                    imported = {local: imported[remote] for local, remote in only
+                                if remote in imported}
+                table.update(imported)
+            for name, expr in info['consts']:
+                value = const_value(expr, table)
+                if value is not None:
+                    table[name] = value
+            tables[key] = table
+        return tables[key]
+
+    return {scope: scope_table(scopes, scope) for scope in scopes}
+
+
+#=============================================
+def const_scopes(lines_in):
+#=============================================
+    """
+      {scope: info} of the converted lines, where scope is the tuple of
+      the program/module/procedure names (in lower case) and info is
+         'kind'    : 'module', 'program', 'subroutine', ...
+         'uses'    : [(module, only, renames), ...], where 'only' (None
+                     without 'only:') and 'renames' are [(local, remote), ...]
+         'consts'  : [(name, expression), ...] of the integer parameters
+         'locals'  : the other names declared in the scope
+         'private' : True when the module is private by default
+         'public'  : the names declared public
+    """
+    pat_use = re.compile(r'^\s*use\s*(?:,\s*non_intrinsic\s*::|::)?\s*([a-z]\w*)\s*'
+                         r'(?:,\s*(only\s*:)?(.*))?$')
+    pat_decl = re.compile(r'^\s*(integer|real|complex|logical|character|type\s*\('
+                          r'|class\s*\(|double\s+precision)(.*?)::(.*)$')
+    pat_const = re.compile(r'<const>|\bparameter\b')
+    pat_entity = re.compile(r'^\s*([a-z]\w*)\s*(=(?!>))?(.*)$')
+    pat_type_in = re.compile(r'^\s*type\s*(,.*)?(::)?\s*[a-z]\w*\s*$')
+    pat_type_out = re.compile(r'^\s*end\s*type\b')
+    pat_private = re.compile(r'^\s*private\s*$')
+    pat_public = re.compile(r'^\s*public\s*(?:::)?(.*)$')
+
+    scopes = dict()
+    in_type = False
+    for line, _, name, kind in routine_name_scopes(lines_in):
+        scope = tuple(n.lower() for n in name)
+        if scope not in scopes:
+            scopes[scope] = dict(kind=(kind[-1] if kind else ''), uses=list(), consts=list(),
+                                 locals=set(), private=False, public=set())
+        info = scopes[scope]
+        code = line[:code_end(lexical_mask(line))].lower()
+
+        if in_type:   # components of a derived type are not declared names.
+            in_type = not pat_type_out.search(code)
+            continue
+        if pat_type_in.search(code):
+            in_type = True
+            continue
+
+        match_use = pat_use.search(code)
+        match_decl = pat_decl.search(code)
+        match_public = pat_public.search(code)
+        if match_use:
+            pairs = list()
+            for item in split_at_top_level_commas(match_use.group(3) or ''):
+                local, _, remote = item.partition('=>')
+                if local.strip():
+                    pairs.append((local.strip(), (remote or local).strip()))
+            if match_use.group(2):
+                info['uses'].append((match_use.group(1), pairs, []))
+            else:
+                info['uses'].append((match_use.group(1), None, pairs))
+        elif match_decl:
+            is_const = match_decl.group(1) == 'integer' and pat_const.search(match_decl.group(2))
+            for item in split_at_top_level_commas(match_decl.group(3)):
+                entity = pat_entity.search(item)
+                if not entity:
+                    continue
+                if is_const and entity.group(2):
+                    info['consts'].append((entity.group(1), entity.group(3)))
+                else:
+                    info['locals'].add(entity.group(1))
+        elif pat_private.search(code) and len(scope) == 1:
+            info['private'] = True
+        elif match_public:
+            for item in split_at_top_level_commas(match_public.group(1)):
+                info['public'].add(item.strip())
+
+    return scopes
+
+
+const_scopes_cache = dict()   # {(filename, alias_list): (mtime, alias_dict, scopes)}
+
+
+#=============================================
+def const_scopes_cached(filename, alias_list):
+#=============================================
+    """
+      const_scopes of another file, which is converted by the line decoders
+      (fuse blocks and __FUNC__ etc. do not matter here). The file is
+      read again only when it, or the alias list, is updated. A file
+      that cannot be read has no scopes, so that its names are left
+      as they are.
+    """
+    alias_dict = line_decode_alias_dict[alias_list]
+    cached = const_scopes_cache.get((filename, alias_list))
+    try:
+        mtime = os.stat(filename).st_mtime_ns
+        if cached is None or cached[0] != mtime or cached[1] is not alias_dict:
+            with open(filename,'r') as f:
+                lines = [line_predecode(l) for l in f.readlines()]
+            lines = [line_decode(alias_list, l) for l in block_comment(lines)]
+            cached = (mtime, alias_dict, const_scopes(lines))
+            const_scopes_cache[(filename, alias_list)] = cached
+    except (OSError, UnicodeDecodeError):
+        return dict()
+    return cached[2]
+
+
+#=============================================
+def const_value(expr, table):
+#=============================================
+    """
+      Value of an integer constant expression, e.g., "grid_nx*2 + 1_si",
+      made of integers, the names in the table, + - * / **, and max,
+      min, abs, and mod; or None. The division is truncated toward
+      zero as in Fortran.
+    """
+    expr = pat_const_kind.sub(r'\1', expr.strip().lower())
+    try:
+        tree = ast.parse(expr, mode='eval')
+    except SyntaxError:
+        return None
+
+    def div(a, b):
+        q = abs(a) // abs(b)
+        return q if (a < 0) == (b < 0) else -q
+
+    def value(node):
+        if isinstance(node, ast.Constant) and type(node.value) is int:
+            return node.value
+        if isinstance(node, ast.Name):
+            return table[node.id]
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.UAdd, ast.USub)):
+            v = value(node.operand)
+            return -v if isinstance(node.op, ast.USub) else v
+        if isinstance(node, ast.BinOp):
+            a, b = value(node.left), value(node.right)
+            if isinstance(node.op, ast.Add):
+                return a + b
+            if isinstance(node.op, ast.Sub):
+                return a - b
+            if isinstance(node.op, ast.Mult):
+                return a * b
+            if isinstance(node.op, ast.Div):
+                return div(a, b)
+            if isinstance(node.op, ast.Pow) and 0 <= b <= 64:
+                return a ** b
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and not node.keywords:
+            args = [value(arg) for arg in node.args]
+            if node.func.id in ('max', 'min') and len(args) >= 2:
+                return max(args) if node.func.id == 'max' else min(args)
+            if node.func.id == 'abs' and len(args) == 1:
+                return abs(args[0])
+            if node.func.id == 'mod' and len(args) == 2:
+                return args[0] - div(args[0], args[1]) * args[1]
+        raise ValueError(expr)
+
+    try:
+        return value(tree.body)
+    except (KeyError, ValueError, ZeroDivisionError):
+        return None
+
+
+pat_const_kind = re.compile(r'(?<!\w)(\d+)_\w+')   # 10_si => 10
+
+
+#=============================================
+def member_access_operator_macro(lines_in):
+#=============================================
+    """
+      Replaces "." to "%", for example,
+
+        > call mhd.sub.update(mhd.main)
+
+      is converted to
+
+        > call mhd%sub%update(mhd%main)
+    """
+    """
+        a3.y14 = 3.10_DR
+        grid.x = 1.0_DR
+    """
+
+    output = list()
+
+    for line in lines_in:
+        line_replaced = replace_period_in_member_accessor(line)
+        output.append(line_replaced)
+
+    return output
+
+
+#=============================================
+def check_implicit_none(filename_in, lines_in):
+#=============================================
+    """
+      Check if the line "implicit none" appears.
+    """
+    error = implicit_none_error(lines_in)
+    if error:
+        error_message = 'Error in '+filename_in+': '+error[1]+'\n'
+        sys.stderr.write(error_message)
+        sys.exit(1)
+
+
+#=============================================
+def implicit_none_error(lines_in):
+#=============================================
+    """
+      Returns None if "implicit none" follows the first program
+      or module statement (after 'use' lines), otherwise
+      (line number, error message). Stops reading lines_in
+      as soon as it is found.
+    """
+    pat_comment = re.compile(r'^\s*\!.*$')
+    pat_blank = re.compile(r'^\s*$')
+    pat_use = re.compile(r'^\s*use\s+[a-zA-Z][a-zA-Z_0-9]*')
+    pat_implicit_none = re.compile(r'^\s*implicit none\s+')
+    pat_program = re.compile(r'^\s*program\s+[a-zA-Z][a-zA-Z_0-9]*')
+    pat_module = re.compile(r'^\s*module\s+[a-zA-Z][a-zA-Z_0-9]*')
+    search_mode_on_for_implicit_none = False
+
+    lctr = 1
+    for lctr, line in enumerate(lines_in, 1):
+        if pat_comment.search(line) or pat_blank.search(line):
+            continue  # Skip comment lines.
+        if search_mode_on_for_implicit_none:
+            if pat_use.search(line):
+                continue  # Skip 'use ***' lines.
+            elif pat_implicit_none.search(line):
+                return None  # O.K. this code is fine.
+            else:
+                break  # Other line appears before "implicit none"
+        elif pat_module.search(line) or pat_program.search(line):
+            search_mode_on_for_implicit_none = True
+
+    return (lctr, 'You forgot "implicit none"')
+
+
+#=============================================
+def clock_decode(lines_in):
+#=============================================
+    """
+     # Before...
+     #   ___________________________________________
+     #                          !{  main}{{STT}}
+     #   call fluid%create(lat) !{  main}{flu cr}
+     #   call fluid%set_initial(lat)
+     #                          !{  main}{flu in}
+     #   do loop = 1 , loop_max !{{count}}
+     #     call pdf%shift(lat)  !{  main}{pdfsht}
+     #   end do
+     #   call fluid%finalize    !{  main}{{END}}
+     #                          !{{print}}
+     #
+     # After...  (You should apply "subsidiary_caller" later.)
+     #   ___________________________________________
+     #                          -call Clock%start('  main')
+     #   call fluid%create(lat) -call Clock%lap  ('  main','flu cr')
+     #   call fluid%set_initial(lat)
+     #                          -call Clock%lap  ('  main','flu in')
+     #   do loop = 1 , loop_max -call Clock%count
+     #     call pdf%shift(lat)  -call Clock%lap  ('  main','pdfsht')
+     #   end do
+     #   call fluid%finalize    -call Clock%stop ('  main')
+     #                          -call Clock%print
+     #
+     # Clock is defined in efpp_clock.f90 (use efpp_clock_m).
+    """
+    output = list()
+    pat_stt = re.compile(r'^(.*)\s+!\{(......)\}\{\{STT\}\}')
+    pat_cal = re.compile(r'^(.*)\s+!\{(......)\}\{(......)\}')
+    pat_cnt = re.compile(r'^(.*)\s+!\{\{count\}\}')
+    pat_end = re.compile(r'^(.*)\s+!\{(......)\}\{\{END\}\}')
+    pat_pri = re.compile(r'^(.*)\s+!\{\{print\}\}(.*)')
+
+    for line in lines_in:
+        match_stt = pat_stt.search(line)
+        match_cal = pat_cal.search(line)
+        match_cnt = pat_cnt.search(line)
+        match_end = pat_end.search(line)
+        match_pri = pat_pri.search(line)
+        if match_stt:
+            line = match_stt.group(1) + ' '
+            line += '-call Clock%start(\'' + match_stt.group(2)
+            line += '\')' + '\n'
+        if match_cal:
+            line = match_cal.group(1) + ' '
+            line += '-call Clock%lap  (\'' + match_cal.group(2)
+            line += '\',\'' +  match_cal.group(3)
+            line += '\')' + '\n'
+        if match_cnt:
+            line = match_cnt.group(1) + ' '
+            line += '-call Clock%count\n'
+        if match_end:
+            line = match_end.group(1) + ' '
+            line += '-call Clock%stop (\'' + match_end.group(2)
+            line += '\')' + '\n'
+        if match_pri:
+            line = match_pri.group(1) + ' '
+            line += '-call Clock%print' + match_pri.group(2) + '\n'
+        output.append(line)
+
+    return output
+
+
+#=============================================
+def operator_decode(lines_in):
+#=============================================
+    """
+      "... val += aa"     is converted into
+      "... val = val + aa"
+
+      "... val -= aa"     is converted into
+      "... val = val - aa"
+
+      "if (xyz>0) xyz *=  2" is converted into
+      "if (xyz>0) xyz = xyz * 2"
+
+      "a(i, j).b **= 2"   is converted into
+      "a(i, j).b = a(i, j).b ** 2"
+
+      "str //= 'abc'"     is converted into
+      "str = str // 'abc'"
+
+      "val -= a + b"      is converted into
+      "val = val - (a + b)"
+
+      but
+
+       "val /= 2" is not converted since
+       it stands for val does not equal to 2.
+
+      Operators in strings and comments are left as they are.
+    """
+
+    output = list()
+
+    for line in lines_in:
+        output.append(compound_assignment_decode(line))
+
+    return output
+
+
+#=============================================
+def compound_operator_at(line, i):
+#=============================================
+    """
+      Returns '+', '-', '*', '**' or '//' if a compound assignment
+      operator (e.g., '+=') starts at line[i], otherwise ''.
+      '/=' is the not-equal operator and is not included.
+    """
+    for op in ('**', '//', '+', '-', '*'):
+        if line.startswith(op + '=', i) and not line.startswith('=', i+len(op)+1):
+            return op
+    return ''
+
+
+#=============================================
+def compound_assignment_lhs_start(line, stmt_stt, op_pos, partner):
+#=============================================
+    """
+      Scans backward from the operator over the left hand side
+      designator, e.g., "abc(i).def(:).g" of
+          "if (ok) abc(i).def(:).g += 1"
+      and returns its start position, or -1 if there is no designator.
+      'partner' maps the position of ')' to that of the matching '('.
+    """
+    def is_ident(c):
+        return c.isalnum() or c == '_'
+
+    k = op_pos
+    while k > stmt_stt and line[k-1] in ' \t':
+        k -= 1
+    lhs_end = k
+
+    while True:
+        if k > stmt_stt and line[k-1] == ')' and (k-1) in partner:
+            k = partner[k-1]
+            if not (k > stmt_stt and (is_ident(line[k-1]) or line[k-1] == ')')):
+                return -1
+        elif k > stmt_stt and is_ident(line[k-1]):
+            while k > stmt_stt and is_ident(line[k-1]):
+                k -= 1
+            if not line[k].isalpha():
+                return -1
+            if ( k-1 > stmt_stt and line[k-1] in '%.'
+                 and (is_ident(line[k-2]) or line[k-2] == ')') ):
+                k -= 1
+            else:
+                break
+        else:
+            return -1
+
+    return k if k < lhs_end else -1
+
+
+#=============================================
+def compound_assignment_decode(line):
+#=============================================
+    """
+      Rewrites every compound assignment in a line. The line is
+      scanned once from left to right, skipping strings and the
+      trailing comment found in the lexical mask, to find the operators at parenthesis depth
+      zero, one per ';'-separated statement. The left hand side is
+      then scanned backward. Thus the cost is linear in the line length.
+
+      The right hand side is put in parentheses unless it is a
+      single operand, or it continues to the next line with '&'
+      (then continued_compound_assignment has put the parentheses).
+    """
+    statements, partner = compound_assignment_statements(line)
+
+    ans = ''
+    pos = 0
+    for stmt_stt, stmt_end, op_pos, op in statements:
+        if not op:
+            continue
+        lhs_stt = compound_assignment_lhs_start(line, stmt_stt, op_pos, partner)
+        rhs = line[op_pos+len(op)+1:stmt_end]
+        rhs_code = rhs.strip()
+        if lhs_stt < 0 or not rhs_code:
+            continue
+        lhs = line[lhs_stt:op_pos].rstrip()
+        if not (rhs_code.endswith('&') or is_single_operand(rhs_code)):
+            rhs_code = '(' + rhs_code + ')'
+        ans += line[pos:lhs_stt]
+        ans += lhs + ' = ' + lhs + ' ' + op + ' ' + rhs_code
+        ans += rhs[len(rhs.rstrip()):]
+        pos = stmt_end
+    ans += line[pos:]
+
+    return ans
+
+
+#=============================================
+def compound_assignment_statements(line):
+#=============================================
+    """
+      Returns ([(start, end, op_pos, op), ...], partner) of the
+      ';'-separated statements in the code of the line, where op is
+      the compound assignment operator at depth zero ('' if none)
+      and partner maps the position of ')' to that of '('.
+    """
+    mask = lexical_mask(line)
+    stack = list()
+    partner = dict()
+    statements = list()   # [(start, end, op_pos, op), ...]
+    stmt_stt = 0
+    op_pos, op = -1, ''
+    pos_end = code_end(mask)
+
+    i = 0
+    while i < pos_end:
+        c = line[i]
+        if mask[i] != 'c':
+            pass
+        elif c == '(':
+            stack.append(i)
+        elif c == ')':
+            if stack:
+                partner[i] = stack.pop()
+        elif c == ';' and not stack:
+            statements.append((stmt_stt, i, op_pos, op))
+            stmt_stt = i + 1
+            op_pos, op = -1, ''
+        elif not stack and not op and c in '+-*/':
+            op = compound_operator_at(line, i)
+            if op:
+                op_pos = i
+                i += len(op) + 1
+                continue
+        i += 1
+    statements.append((stmt_stt, pos_end, op_pos, op))
+
+    return statements, partner
+
+
+#=============================================
+def continued_compound_assignment(lines_in):
+#=============================================
+    """
+      A compound assignment whose right hand side continues
+      to the next lines gets the parentheses here, since
+      operator_decode sees one line at a time.
+
+          x -= a  &           x -= (a  &
+               + b      ==>        + b)
+          y *= c + &          y *= (c + &
+               d  ! ok             d)  ! ok
+
+      Then operator_decode makes "x = x - (a  &" and "y = y * (c + &".
+      The ')' is put at the end of the code of the last continued
+      line, or before its first ';' at depth zero.
+    """
+    output = list(lines_in)
+
+    for lctr, line in enumerate(lines_in):
+        if '&' not in line or not pat_compound_quick.search(line):
+            continue
+        mask = lexical_mask(line)
+        code = line[:code_end(mask)].rstrip()
+        if not code.endswith('&'):
+            continue
+        statements, partner = compound_assignment_statements(line)
+        stmt_stt, _, op_pos, op = statements[-1]
+        if not op:
+            continue
+        if compound_assignment_lhs_start(line, stmt_stt, op_pos, partner) < 0:
+            continue
+
+        # Find the end of the statement in the following lines.
+        depth = 0
+        for i in range(op_pos, len(code)):
+            if mask[i] == 'c' and line[i] in '()':
+                depth += 1 if line[i] == '(' else -1
+        for n in range(lctr+1, len(lines_in)):
+            next_line = output[n]
+            next_mask = lexical_mask(next_line)
+            pos_end = code_end(next_mask)
+            if not next_line[:pos_end].strip():
+                continue   # comment or blank line between the continued lines.
+            close = -1
+            for i in range(pos_end):
+                c = next_line[i]
+                if next_mask[i] != 'c':
+                    pass
+                elif c == '(':
+                    depth += 1
+                elif c == ')':
+                    depth -= 1
+                elif c == ';' and depth == 0:
+                    close = len(next_line[:i].rstrip())
+                    break
+            if close < 0 and next_line[:pos_end].rstrip().endswith('&'):
+                continue
+            if close < 0:
+                close = len(next_line[:pos_end].rstrip())
+            output[n] = next_line[:close] + ')' + next_line[close:]
+            pos = op_pos + len(op) + 1
+            output[lctr] = line[:pos] + ' (' + line[pos:].lstrip(' ')
+            break
+
+    return output
+
+
+pat_compound_quick = re.compile(r'(\*\*|//|[+\-*])=')
+
+
+#=============================================
+def is_single_operand(string_in):
+#=============================================
+    """
+      True for "a", "a.b(i,j)%c", "3.14_DR", "1.e-5", "(a+b)", "'str'",
+      False for "a+b", "-a", "a*b(i)", ".not. a", "a(i) // b".
+    """
+    pat_number = r'^(\d+\.?\d*|\.\d+)([eEdD][\+\-]?\d+)?(_\w+)?$'
+    if re.match(pat_number, string_in):
+        return True
+
+    mask = lexical_mask(string_in)
+    depth = 0
+    for i, c in enumerate(string_in):
+        if mask[i] == 's':
+            pass
+        elif c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+        elif depth == 0 and not (c.isalnum() or c in '_%.'):
+            return False
+        elif depth == 0 and c == '.' and i > 0 and not string_in[i-1].isalnum():
+            return False
+    return not string_in.startswith('.')
+
+
+#=============================================
+def debugp_decode(lines_in):
+#=============================================
+    """
+      !debugp val
+    =>
+      print *, "\\modname(linenum): ", "val =", val
+
+      !debugp "str"
+    =>
+      print *, "\\modname(linenum): ", "str"
+
+      !debugp "str", val1
+    =>
+      print *, "\\modname(linenum): ", "str", "val1 = ", val1
+
+      !debugp "str", val1, val2, ...
+    =>
+      print *, "\\modname(linenum): ", "str", "val1 = ", val1, "val2 = ", ...
+
+      !debugp "str1", val1, "str2", val2, ...
+    =>
+      print *, "\\modname(linenum): ", "str1", "val1 = ", val1, "str2", "val2 = ", ...
+    """
+    output = list()
+
+    pat = re.compile(r'!debugp\s+(.*)$')
+
+    for line in lines_in:
+        pos = code_end(lexical_mask(line))  # '!debugp' must start the comment.
+        match = pat.match(line, pos)
+        if match:
+            args = match.group(1).split(',')
+            line = line[:pos]
+            if line.strip():  # it's not empty.
+                line += ';'
+            line += 'print *, '
+            line += '\"\\\\__MODULE__(__LINE__): \", '
+            countParenthesis = 0
+            temp = ''
+            for arg in args:
+                a = arg.strip() # put off blanks
+                if a[0]=='\'' or a[0]=='\"':  # string (e.g., 'message')
+                    if a[-1]=='\'' or a[-1]=='\"':  # string (e.g., 'say,...)
+                        line += a + ', '
+                    else:
+                        line += a + ', ' + a[0] + ', '
+                elif a[-1]=='\'' or a[-1]=='\"':# string (e.g., '..., smthng')
+                    line +=  a[-1] + a + ', '
+                elif '(' in a or countParenthesis!=0:
+                    if '(' in a:
+                        countParenthesis += a.count('(') - a.count(')')
+                        temp += a + ', '
+                        if countParenthesis == 0:
+                            temp = temp[:-2]  # put of the last "comma + space"
+                            line += "\" " + temp + " = \", " + temp + ', '
+                    elif ')' in a:
+                        countParenthesis += a.count('(') - a.count(')')
+                        temp += a + ', '
+                        if countParenthesis == 0:
+                            temp = temp[:-2]  # put of the last "comma + space"
+                            line += "\" " + temp + " = \", " + temp + ', '
+                    else:
+                        temp += a + ', '
+                else:
+                    line += "\" " + a + " = \", " + a + ', '
+            line = line[:-2]  # put of the last "comma + space"
+            line += '\n'
+        output.append(line)
+
+    return output
+
+
+#=============================================
+def efpp(filename_in, alias_list, instrument='', profile=False, specialize=False):
+#=============================================
+
+    """    A preprocessor for Fortran 2003.
+
+         input: filename_in (e.g., 'main.ef')
+        output: standard out
+    """
+    for l in efpp_lines(filename_in, alias_list, instrument, profile, specialize):
+        print(l,end='')
+
+
+#=============================================
+def efpp_lines(filename_in, alias_list, instrument='', profile=False, specialize=False):
+#=============================================
+    """
+         input: filename_in (e.g., 'main.ef')
+        output: list of the converted lines
+
+        instrument = 'count' or 'time' for --instrument(=time)
+        profile = True for --profile (time and line cache hit rate
+                  are written to stderr)
+        specialize = True for --specialize (integer parameters in
+                     loop bounds and shapes are replaced by values)
+    """
+    with open(filename_in,'r') as f:
+        lines = f.readlines()
+
+    return convert_lines(filename_in, lines, alias_list, instrument, profile, specialize)
+
+
+#=============================================
+def convert_lines(filename_in, lines, alias_list, instrument='', profile=False, specialize=False):
+#=============================================
+    """
+        Same as efpp_lines, for the lines already read.
+    """
+    clock = time.perf_counter()
+    hits, misses = line_decode.cache_info()[:2]
+
+    # The line-by-line decoders are applied in 'line_predecode'
+    # and 'line_decode', with caches. The decoders that need other
+    # lines are applied between ('block_comment', 'array_fusion_block',
+    # and 'continued_compound_assignment') or after ('routine_name_macro',
+    # which expands __LINE__, __FUNC__, etc., and 'const_bound_macro') them.
+    lines = [line_predecode(l) for l in lines]
+    lines = block_comment(lines)
+    lines = array_fusion_block(filename_in, lines)
+    lines = continued_compound_assignment(lines)
+    alias_dict = make_alias_dict(alias_list)
+    if line_decode_alias_dict.get(alias_list) != alias_dict:
+        line_decode_alias_dict[alias_list] = alias_dict
+        line_decode.cache_clear()
+    lines = [line_decode(alias_list, l) for l in lines]
+    lines = routine_name_macro(lines)
+    if specialize:
+        lines = const_bound_macro(filename_in, alias_list, lines)
+    if instrument:
+        lines = instrument_routines(lines, timer=(instrument=='time'))
+
+    check_implicit_none(filename_in, lines)
+
+    if profile:
+        hits_, misses_ = line_decode.cache_info()[:2]
+        hits, misses = hits_ - hits, misses_ - misses
+        sys.stderr.write('efpp profile: ' + filename_in
+                         + ': {} lines, {:.6f} s, line cache hit rate {:.1f}% ({}/{})\n'.format(
+                           len(lines), time.perf_counter() - clock,
+                           100*hits/max(hits+misses,1), hits, hits+misses))
+
+    return lines
+
+
+LINE_CACHE_SIZE = 16384
+line_decode_alias_dict = dict()   # {alias_list: alias_dict} used in line_decode
+
+
+#=============================================
+@functools.lru_cache(maxsize=LINE_CACHE_SIZE)
+def line_predecode(line):
+#=============================================
+    """
+      The line decoders applied before 'block_comment', so that the
+      clock markers and ' -call ' are converted in block comments too,
+      as they have been.
+    """
+    lines = [line]
+    lines = clock_decode(lines)
+    lines = subsdiary_call_decode(lines)
+    return lines[0]
+
+
+#=============================================
+@functools.lru_cache(maxsize=LINE_CACHE_SIZE)
+def line_decode(alias_list, line):
+#=============================================
+    """
+      Applies the decoders that see only one line. Repeated
+      lines, like "do i bulk" or "end do", are converted once
+      and taken from the (LRU) cache afterwards.
+
+      The call-order is basically arbitrary, with
+      the following caveat:
+
+      (1) 'clock_decode' shoud be called before
+          'subsdiary_call_decode' (both in 'line_predecode').
+      (2) 'alias_docode' should be called before
+          'routine_name_macro', since __LINE__ etc,
+          could be included in 'efpp_alias.list'.
+    """
+    lines = [line]
+    lines = operator_decode(lines)
+    lines = just_once_region(lines)
+    lines = skip_counter(lines)
+    lines = [alias_decode_line(line_decode_alias_dict[alias_list], lines[0])]
+    lines = debugp_decode(lines)
+    lines = member_access_operator_macro(lines)
+    return lines[0]
+
+
+#=============================================
+def write_if_changed(filename, text):
+#=============================================
+    """
+      Writes the file only when its content changes, so that
+      make does not rebuild the object file for nothing.
+      Returns True if the file is written.
+    """
+    try:
+        with open(filename,'r') as f:
+            if f.read() == text:
+                return False
+    except FileNotFoundError:
+        pass
+    with open(filename,'w') as f:
+        f.write(text)
+    return True
+
+
+#=============================================
+def regenerate(filename_in, alias_list):
+#=============================================
+    """
+      main.ef ==> main.F90 (in the same directory)
+    """
+    filename_out = os.path.splitext(filename_in)[0] + '.F90'
+    try:
+        lines = efpp_lines(filename_in, alias_list)
+        changed = write_if_changed(filename_out, ''.join(lines))
+    except SystemExit:
+        # The error message is already written. Keep watching.
+        return
+    except (OSError, UnicodeDecodeError) as e:
+        # E.g., the file is gone for a moment while an editor saves
+        # it by renaming; the next event will bring it back.
+        sys.stderr.write('Error in ' + filename_in + ': ' + str(e) + '\n')
+        return
+    if changed:
+        sys.stderr.write('efpp: ' + filename_in + ' => ' + filename_out + '\n')
+
+
+#=============================================
+def scan_mtimes(dirname, alias_list):
+#=============================================
+    """
+      {filename: mtime} of the eFortran sources in dirname and
+      of the alias list, with a single scandir call.
+    """
+    mtimes = dict()
+    with os.scandir(dirname) as it:
+        for entry in it:
+            if entry.name.endswith(WATCH_SUFFIXES) and entry.is_file():
+                try:
+                    mtimes[entry.path] = entry.stat().st_mtime_ns
+                except FileNotFoundError:
+                    pass   # removed after listed.
+    try:
+        mtimes[alias_list] = os.stat(alias_list).st_mtime_ns
+    except FileNotFoundError:
+        pass
+    return mtimes
+
+
+WATCH_SUFFIXES = ('.ef', '.e03')
+
+
+#=============================================
+def inotify_open(dirnames):
+#=============================================
+    """
+      Returns an inotify file descriptor watching the directories,
+      or None where inotify is not available (non-Linux systems).
+    """
+    IN_MODIFY, IN_CLOSE_WRITE, IN_MOVED_TO, IN_CREATE, IN_DELETE = (
+        0x2, 0x8, 0x80, 0x100, 0x200 )
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    for dirname in dirnames:
+        mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+        if libc.inotify_add_watch(fd, os.fsencode(dirname), mask) < 0:
+            os.close(fd)
+            return None
+    return fd
+
+
+#=============================================
+def wait_for_event(fd, interval):
+#=============================================
+    """
+      Sleeps until something happens in the watched directories.
+      Without inotify, simply sleeps for the polling interval.
+    """
+    if fd is None:
+        time.sleep(interval)
+        return
+    select.select([fd], [], [])
+    try:
+        while os.read(fd, 65536):
+            pass
+    except BlockingIOError:
+        pass
+
+
+#=============================================
+def efpp_watch(dirname, alias_list, interval=0.5, debounce=0.2):
+#=============================================
+    """
+      efpp.py --watch DIR
+
+      Converts all the *.ef files in DIR into *.F90 files, and keeps
+      converting them whenever they are saved. When the alias list
+      is updated, all the files are converted again. A burst of saves
+      is handled at once after the mtimes stay unchanged for 'debounce'
+      seconds. A .F90 file is written only when its content changes.
+    """
+    fd = inotify_open({dirname, os.path.dirname(alias_list) or '.'})
+    if fd is None:
+        sys.stderr.write('efpp: polling ' + dirname + ' every ' + str(interval) + ' s\n')
+    else:
+        sys.stderr.write('efpp: watching ' + dirname + ' with inotify\n')
+
+    mtimes = scan_mtimes(dirname, alias_list)
+    for filename in sorted(mtimes):
+        if filename != alias_list:
+            regenerate(filename, alias_list)
+
+    try:
+        while True:
+            wait_for_event(fd, interval)
+            mtimes_new = scan_mtimes(dirname, alias_list)
+            if mtimes_new == mtimes:
+                continue
+            while True:  # debounce
+                time.sleep(debounce)
+                mtimes_now = scan_mtimes(dirname, alias_list)
+                if mtimes_now == mtimes_new:
+                    break
+                mtimes_new = mtimes_now
+            if mtimes_new.get(alias_list) != mtimes.get(alias_list):
+                changed = [f for f in mtimes_new if f != alias_list]
+            else:
+                changed = [f for f in mtimes_new if mtimes_new[f] != mtimes.get(f)]
+            for filename in sorted(changed):
+                regenerate(filename, alias_list)
+            mtimes = mtimes_new
+    except KeyboardInterrupt:
+        pass
+
+
+#=============================================
+def efpp_batch(filenames, alias_list, instrument='', specialize=False, profile=False,
+               concurrency=16):
+#=============================================
+    """
+      efpp.py --batch a.ef b.ef c.ef ...
+
+      Converts a.ef into a.F90, etc. The files are read and written in
+      threads by asyncio, so that the file system latency is hidden
+      behind the conversion, which runs in the main thread. At most
+      'concurrency' files are read ahead of the conversion, and at most
+      'concurrency' are written at once; the writes do not wait for the
+      reads. A .F90 file is written only when its content changes.
+      A file that cannot be read, converted, or written is reported
+      and skipped. The time spent in I/O and in the conversion is
+      written to stderr. Returns the number of files with errors.
+    """
+    return asyncio.run(efpp_batch_async(filenames, alias_list, instrument, specialize,
+                                        profile, concurrency))
+
+
+#=============================================
+async def efpp_batch_async(filenames, alias_list, instrument, specialize, profile, concurrency):
+#=============================================
+    write_semaphore = asyncio.Semaphore(concurrency)
+    io_time = [0.0]   # sum over the threads; they overlap each other.
+    errors = [0]
+
+    def read_lines(filename):
+        with open(filename,'r') as f:
+            return f.readlines()
+
+    def timed(func, *args):
+        clock = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            io_time[0] += time.perf_counter() - clock
+
+    def report(filename, e):
+        sys.stderr.write('Error in ' + filename + ': ' + str(e) + '\n')
+        errors[0] += 1
+
+    async def write(filename_out, text):
+        async with write_semaphore:
+            try:
+                return await asyncio.to_thread(timed, write_if_changed, filename_out, text)
+            except OSError as e:
+                report(filename_out, e)
+                return False
+
+    def read_ahead(n):
+        if n < len(filenames):
+            reads.append(asyncio.ensure_future(asyncio.to_thread(timed, read_lines, filenames[n])))
+
+    clock_stt = time.perf_counter()
+    compute_time = 0.0
+    wait_time = 0.0
+
+    reads = collections.deque()   # sliding window of the reads ahead.
+    for n in range(concurrency):
+        read_ahead(n)
+    writes = list()
+    for n, filename in enumerate(filenames):
+        read = reads.popleft()
+        read_ahead(n + concurrency)
+
+        clock = time.perf_counter()
+        try:
+            lines = await read
+        except (OSError, UnicodeDecodeError) as e:
+            lines = None
+            report(filename, e)
+        wait_time += time.perf_counter() - clock
+
+        clock = time.perf_counter()
+        try:
+            if lines is not None:
+                lines = convert_lines(filename, lines, alias_list, instrument, profile, specialize)
+        except SystemExit:
+            # The error message is already written. Go on to the next.
+            lines = None
+            errors[0] += 1
+        compute_time += time.perf_counter() - clock
+
+        if lines is not None:
+            filename_out = os.path.splitext(filename)[0] + '.F90'
+            writes.append(asyncio.ensure_future(write(filename_out, ''.join(lines))))
+        await asyncio.sleep(0)  # let the finished reads and writes go on.
+
+    clock = time.perf_counter()
+    written = sum(await asyncio.gather(*writes))
+    wait_time += time.perf_counter() - clock
+
+    sys.stderr.write('efpp batch: {} files ({} written, {} errors), '
+                     'wall {:.6f} s, compute {:.6f} s, I/O {:.6f} s '
+                     '(waited {:.6f} s)\n'.format(
+                     len(filenames), written, errors[0],
+                     time.perf_counter() - clock_stt,
+                     compute_time, io_time[0], wait_time))
+    return errors[0]
+
+
+#=============================================
+def check_file(filename_in):
+#=============================================
+    """
+      Returns the list of the problems in the file as
+          ['main.ef:12: error: You forgot "implicit none"', ...]
+      Only the block comments are decoded, since the other
+      decoders do not change the program/module statements
+      and "implicit none", and the file is read only up to
+      "implicit none". A file that cannot be read is reported
+      at line 0.
+    """
+    try:
+        with open(filename_in,'r') as f:
+            error = implicit_none_error(block_commented(f))
+    except (OSError, UnicodeDecodeError) as e:
+        error = (0, str(e))
+    if error:
+        return [filename_in + ':' + str(error[0]) + ': error: ' + error[1]]
+    return []
+
+
+#=============================================
+def efpp_check(paths):
+#=============================================
+    """
+      efpp.py --check [file or directory ...]
+
+      Checks the eFortran files (the directories are searched
+      recursively) in parallel, and prints all the problems in
+      the "file:line: error: message" format, which can be read
+      by Vim's quickfix. Returns the number of the problems.
+    """
+    filenames = list()
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, dirnames, files in os.walk(path):
+                dirnames.sort()
+                for name in sorted(files):
+                    if name.endswith(WATCH_SUFFIXES):
+                        filenames.append(os.path.join(dirpath, name))
+        else:
+            filenames.append(path)
+
+    if len(filenames) < CHECK_PARALLEL_MIN_FILES:
+        results = map(check_file, filenames)
+        problems = [p for result in results for p in result]
+    else:
+        with concurrent.futures.ProcessPoolExecutor() as executor:
+            results = executor.map(check_file, filenames, chunksize=32)
+            problems = [p for result in results for p in result]
+
+    for problem in problems:
+        print(problem)
+    return len(problems)
+
+
+CHECK_PARALLEL_MIN_FILES = 64   # Fewer files are checked in this process.
+
+
+if __name__ == '__main__':
+
+    if len(sys.argv)>1 and sys.argv[1]=='--watch':
+        dirname = sys.argv[2] if len(sys.argv)>2 else '.'
+        if len(sys.argv)>3:
+            filename_alias_list = sys.argv[3]
+        else:
+            filename_alias_list = os.path.join(dirname, 'efpp_alias.list')
+        efpp_watch(dirname, filename_alias_list)
+        sys.exit(0)
+
+    args = sys.argv[1:]
+    instrument = ''
+    profile = False
+    specialize = False
+    batch = False
+    if len(args)>0 and args[0]=='--check':
+        sys.exit(1 if efpp_check(args[1:] or ['.']) else 0)
+    while len(args)>0 and args[0] in ('--instrument', '--instrument=time', '--profile',
+                                      '--specialize', '--batch'):
+        if args[0]=='--profile':
+            profile = True
+        elif args[0]=='--specialize':
+            specialize = True
+        elif args[0]=='--batch':
+            batch = True
+        else:
+            instrument = 'time' if args[0]=='--instrument=time' else 'count'
+        args = args[1:]
+
+    if batch:
+        sys.exit(1 if efpp_batch(args, 'efpp_alias.list', instrument, specialize, profile) else 0)
+
+    if len(args)==0:
+        filename_in = input('enter filename_in name > ')
+        filename_alias_list = 'efpp_alias.list'
+    elif len(args)==1:
+        filename_in = args[0]
+        filename_alias_list = 'efpp_alias.list'
+    else:
+        filename_in = args[0]
+        filename_alias_list = args[1]
+
+    efpp(filename_in, filename_alias_list, instrument, profile, specialize)
@@ -0,0 +1,132 @@
+!
+!  efpp_profile.f90:
+!    Entry counters and timers for "efpp.py --instrument".
+!
+!        efpp.py --instrument       ==> call efpp_profile__count(key,'module/sub')
+!        efpp.py --instrument=time  ==> call efpp_profile__enter(key,'module/sub')
+!                                       call efpp_profile__leave(key)
+!        end program                ==> call efpp_profile__dump()
+!
+!    The key is a hash of the 'module/sub' path computed by efpp,
+!    so a call is counted by integer comparison in an open addressing
+!    table; the path is copied only at the first call. The time is
+!    measured by system_clock with int64 counts. Nothing is allocated.
+!
+!    The dump lines start with "efpp_profile:". To see the hot routines,
+!        ./a.out | grep efpp_profile: | sort -k2 -n -r
+!
+!  Home page:
+!     https://github.com/akageyama/efpp
+!
+module efpp_profile_m
+  use iso_fortran_env, only : int64, real64, output_unit
+  implicit none
+  private
+  public :: efpp_profile__count,  &
+            efpp_profile__enter,  &
+            efpp_profile__leave,  &
+            efpp_profile__dump
+
+  integer, parameter :: NSLOTS = 4096
+  integer, parameter :: NAME_LEN = 128
+  integer, parameter :: DEPTH_MAX = 256
+
+  integer, dimension(NSLOTS), save :: slot_key = 0
+  character(len=NAME_LEN), dimension(NSLOTS), save :: slot_name = ''
+  integer(int64), dimension(NSLOTS), save :: slot_calls = 0
+  integer(int64), dimension(NSLOTS), save :: slot_ticks = 0
+
+  integer, save :: depth = 0
+  integer, dimension(DEPTH_MAX), save :: stack_slot = 0
+  integer(int64), dimension(DEPTH_MAX), save :: stack_stt = 0
+
+  logical, save :: overflowed = .false.
+
+contains
+
+  function slot_index(key, name) result(ans)
+    integer, intent(in) :: key
+    character(len=*), intent(in) :: name
+    integer :: ans, n
+
+    ans = mod(key, NSLOTS) + 1
+    do n = 1 , NSLOTS
+      if ( slot_key(ans) == key ) return
+      if ( slot_key(ans) == 0 ) then
+        slot_key(ans) = key
+        slot_name(ans) = name
+        return
+      end if
+      ans = mod(ans, NSLOTS) + 1
+    end do
+    overflowed = .true.
+    ans = 0
+  end function slot_index
+
+
+  subroutine efpp_profile__count(key, name)
+    integer, intent(in) :: key
+    character(len=*), intent(in) :: name
+    integer :: s
+
+    s = slot_index(key, name)
+    if ( s == 0 ) return
+    slot_calls(s) = slot_calls(s) + 1
+  end subroutine efpp_profile__count
+
+
+  subroutine efpp_profile__enter(key, name)
+    integer, intent(in) :: key
+    character(len=*), intent(in) :: name
+    integer(int64) :: now
+    integer :: s
+
+    call system_clock(now)
+    s = slot_index(key, name)
+    if ( s == 0 ) return
+    slot_calls(s) = slot_calls(s) + 1
+    if ( depth == DEPTH_MAX ) then
+      overflowed = .true.
+      return
+    end if
+    depth = depth + 1
+    stack_slot(depth) = s
+    stack_stt(depth) = now
+  end subroutine efpp_profile__enter
+
+
+  subroutine efpp_profile__leave(key)
+    integer, intent(in) :: key
+    integer(int64) :: now
+    integer :: s
+
+    call system_clock(now)
+    ! Unwind the routines left without calling leave, if any.
+    do while ( depth > 0 )
+      s = stack_slot(depth)
+      slot_ticks(s) = slot_ticks(s) + (now - stack_stt(depth))
+      depth = depth - 1
+      if ( slot_key(s) == key ) return
+    end do
+  end subroutine efpp_profile__leave
+
+
+  subroutine efpp_profile__dump()
+    !
+    ! efpp_profile:        1000   1.234567E-03  vecfield_m/vecfield__init
+    !
+    integer(int64) :: rate
+    integer :: s
+
+    call system_clock(count_rate=rate)
+    do s = 1 , NSLOTS
+      if ( slot_key(s) == 0 ) cycle
+      write(output_unit,'(a,i12,es15.6,2x,a)') 'efpp_profile:', slot_calls(s),  &
+           real(slot_ticks(s),real64) / max(rate,1_int64), trim(slot_name(s))
+    end do
+    if ( overflowed ) then
+      write(output_unit,'(a)') 'efpp_profile: warning: table is full, some calls are not counted.'
+    end if
+  end subroutine efpp_profile__dump
+
+end module efpp_profile_m